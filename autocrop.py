@@ -0,0 +1,123 @@
+import numpy as np
+import vtk
+import itk
+from vtk.util import numpy_support
+
+"""
+    Automatic cropping to the non-background region of a volume.
+    The bounding box is found in one pass over the voxels (slab by slab, from
+    the z profile and the yx projection); cropped images keep their physical
+    position, so results map back onto the original grid.
+"""
+
+
+def occupied_bounds(shape, occupied_slab, margin=0, slab_slices=16):
+    # Bounding box of the voxels flagged by occupied_slab(z0, z1), a boolean
+    # (z, y, x) slab; returns (start, size) in (x, y, z) index order, or None
+    z_occupied = np.zeros(shape[0], dtype=bool)
+    yx_occupied = np.zeros(shape[1:], dtype=bool)
+    for z0 in range(0, shape[0], slab_slices):
+        occupied = occupied_slab(z0, z0 + slab_slices)
+        z_occupied[z0 : z0 + slab_slices] = occupied.any(axis=(1, 2))
+        yx_occupied |= occupied.any(axis=0)
+
+    if not z_occupied.any():
+        return None
+    start, size = [], []
+    for occupied, dim in [
+        (yx_occupied.any(axis=0), shape[2]),
+        (yx_occupied.any(axis=1), shape[1]),
+        (z_occupied, shape[0]),
+    ]:
+        indices = np.flatnonzero(occupied)
+        low = max(int(indices[0]) - margin, 0)
+        high = min(int(indices[-1]) + margin + 1, dim)
+        start.append(low)
+        size.append(high - low)
+    return tuple(start), tuple(size)
+
+
+def foreground_bounds(array, background=0, margin=0, slab_slices=16):
+    # array is (z, y, x) or (z, y, x, components); the whole grid is returned
+    # when there is no foreground
+    def occupied_slab(z0, z1):
+        occupied = array[z0:z1] != background
+        if occupied.ndim == 4:
+            occupied = occupied.any(axis=-1)
+        return occupied
+
+    shape = array.shape[:3]
+    bounds = occupied_bounds(shape, occupied_slab, margin, slab_slices)
+    return ((0, 0, 0), shape[::-1]) if bounds is None else bounds
+
+
+def crop_image(image, margin=0, background=0):
+    # ITK image cropped to its foreground; the origin moves with the crop
+    start, size = foreground_bounds(
+        itk.array_view_from_image(image), background, margin
+    )
+    region = itk.ImageRegion[image.GetImageDimension()]()
+    region.SetIndex(start)
+    region.SetSize(size)
+    roi = itk.RegionOfInterestImageFilter.New(Input=image, RegionOfInterest=region)
+    roi.Update()
+    cropped = roi.GetOutput()
+    cropped.DisconnectPipeline()
+    return cropped
+
+
+def image_geometry(image):
+    # Empty image with the grid of image, to map crops back without keeping
+    # the original voxels alive
+    geometry = type(image).New()
+    geometry.CopyInformation(image)
+    return geometry
+
+
+def crop_offset(cropped, reference):
+    # Index of the cropped image's first voxel on the reference grid
+    index = reference.TransformPhysicalPointToIndex(cropped.GetOrigin())
+    return tuple(int(i) for i in index)
+
+
+def uncrop_image(cropped, reference, fill=0):
+    # Paste a cropped image back onto the full reference grid
+    x, y, z = crop_offset(cropped, reference)
+    array = itk.array_view_from_image(cropped)
+    full = np.full(tuple(itk.size(reference))[::-1], fill, dtype=array.dtype)
+    full[z : z + array.shape[0], y : y + array.shape[1], x : x + array.shape[2]] = array
+    image = itk.image_from_array(full)
+    image.CopyInformation(reference)
+    return image
+
+
+def crop_vtk_reader(reader, margin=0, background=0):
+    # VTK counterpart for reader outputs: the cropped image starts at extent 0
+    # with its origin shifted, so code indexing from 0 works unchanged
+    image = reader.GetOutput()
+    scalars = numpy_support.vtk_to_numpy(image.GetPointData().GetScalars())
+    nx, ny, nz = image.GetDimensions()
+    start, size = foreground_bounds(
+        scalars.reshape((nz, ny, nx, -1)), background, margin
+    )
+    x0, y0, z0 = (e + s for e, s in zip(image.GetExtent()[::2], start))
+
+    voi = vtk.vtkExtractVOI()
+    voi.SetInputConnection(reader.GetOutputPort())
+    voi.SetVOI(x0, x0 + size[0] - 1, y0, y0 + size[1] - 1, z0, z0 + size[2] - 1)
+    voi.Update()
+    cropped = voi.GetOutput()
+
+    rebased = vtk.vtkImageChangeInformation()
+    rebased.SetInputConnection(voi.GetOutputPort())
+    rebased.SetOutputExtentStart(0, 0, 0)
+    rebased.SetOutputOrigin(
+        *(
+            o + e * s
+            for o, e, s in zip(
+                cropped.GetOrigin(), cropped.GetExtent()[::2], cropped.GetSpacing()
+            )
+        )
+    )
+    rebased.Update()
+    return rebased
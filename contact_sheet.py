@@ -0,0 +1,170 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+"""
+    Headless QA contact sheets.
+    Every Nth slice along each axis is mapped with the sample2.py bwLut
+    (grey ramp over [min, max / 2]), overlaid with the tumor mask in red, and
+    the slices are packed into one sheet per axis. Slices are rendered across
+    a process pool; workers decode each volume once.
+"""
+
+AXES = {"sagittal": 2, "coronal": 1, "axial": 0}
+LUT_SIZE = 256
+MASK_COLOR = (255, 0, 0)
+MASK_ALPHA = 0.5
+
+_volumes = {}
+
+
+def read_volume(path):
+    # Same readers as sample2.open_vtk_file; returns a (z, y, x) array
+    if path.endswith(".mha"):
+        reader = vtk.vtkMetaImageReader()
+    else:
+        reader = vtk.vtkDataSetReader()
+    reader.SetFileName(path)
+    reader.Update()
+    image = reader.GetOutput()
+    if path.endswith(".vtk"):
+        image.GetPointData().SetActiveScalars("s")
+    scalars = numpy_support.vtk_to_numpy(image.GetPointData().GetScalars())
+    nx, ny, nz = image.GetDimensions()
+    return scalars.reshape((nz, ny, nx, -1))[..., 0]
+
+
+def _load(path, mask_path):
+    # Per-worker cache, so a study is decoded once per worker
+    key = (path, mask_path)
+    if key not in _volumes:
+        _volumes.clear()
+        volume = read_volume(path)
+        mask = read_volume(mask_path) if mask_path else None
+        if mask is not None and mask.shape != volume.shape:
+            raise ValueError(
+                f"mask shape={mask.shape} does not match volume shape={volume.shape}"
+            )
+        _volumes[key] = (volume, mask, (float(volume.min()), float(volume.max())))
+    return _volumes[key]
+
+
+def bw_lut(values, low, high):
+    # vtkLookupTable with SetValueRange(0, 1), no saturation and its default
+    # S-curve ramp: a linear index into LUT_SIZE grey levels, clamped to the
+    # table range
+    scale = LUT_SIZE / (high - low) if high > low else 0.0
+    index = np.clip(((values - low) * scale).astype(np.int64), 0, LUT_SIZE - 1)
+    value = np.arange(LUT_SIZE) / (LUT_SIZE - 1)
+    levels = (127.5 * (1.0 + np.cos((1.0 - value) * np.pi))).astype(np.uint8)
+    return levels[index]
+
+
+def render_slice(volume, mask, scalar_range, axis, index):
+    # RGB slice, row 0 at the bottom like the VTK image
+    grey = bw_lut(
+        np.take(volume, index, axis=axis), scalar_range[0], scalar_range[1] / 2
+    )
+    rgb = np.repeat(grey[..., None], 3, axis=-1)
+    if mask is not None:
+        inside = np.take(mask, index, axis=axis) > 0
+        rgb[inside] = (
+            rgb[inside] * (1 - MASK_ALPHA) + np.array(MASK_COLOR) * MASK_ALPHA
+        ).astype(np.uint8)
+    return rgb
+
+
+def _render_slices(path, mask_path, axis, indices):
+    volume, mask, scalar_range = _load(path, mask_path)
+    return [render_slice(volume, mask, scalar_range, axis, i) for i in indices]
+
+
+def pack_sheet(tiles, columns, padding=2):
+    # Tiles in reading order (left to right, top to bottom)
+    height, width = tiles[0].shape[:2]
+    rows = -(-len(tiles) // columns)
+    sheet = np.zeros(
+        (rows * (height + padding) + padding, columns * (width + padding) + padding, 3),
+        dtype=np.uint8,
+    )
+    for i, tile in enumerate(tiles):
+        row, column = divmod(i, columns)
+        y = padding + row * (height + padding)
+        x = padding + column * (width + padding)
+        sheet[y : y + height, x : x + width] = tile[::-1]
+    return sheet
+
+
+def write_png(rgb, path):
+    image = vtk.vtkImageData()
+    image.SetDimensions(rgb.shape[1], rgb.shape[0], 1)
+    pixels = np.ascontiguousarray(rgb[::-1]).reshape(-1, 3)
+    image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(pixels, deep=True))
+    writer = vtk.vtkPNGWriter()
+    writer.SetFileName(path)
+    writer.SetInputData(image)
+    writer.Write()
+
+
+def read_volume_shape(path):
+    # Dimensions from the header only, in (z, y, x) order
+    if path.endswith(".mha"):
+        reader = vtk.vtkMetaImageReader()
+    else:
+        reader = vtk.vtkDataSetReader()
+    reader.SetFileName(path)
+    reader.UpdateInformation()
+    info = reader.GetOutputInformation(0)
+    extent = info.Get(vtk.vtkStreamingDemandDrivenPipeline.WHOLE_EXTENT())
+    if extent is None:
+        return read_volume(path).shape
+    return tuple(extent[2 * i + 1] - extent[2 * i] + 1 for i in (2, 1, 0))
+
+
+def contact_sheets(pool, path, mask_path=None, step=4, columns=8, chunk=8):
+    # Returns {axis name: sheet}; slices are rendered in chunks on the pool
+    shape = read_volume_shape(path)
+    futures = {}
+    for name, axis in AXES.items():
+        indices = list(range(0, shape[axis], step))
+        futures[name] = [
+            pool.submit(_render_slices, path, mask_path, axis, indices[i : i + chunk])
+            for i in range(0, len(indices), chunk)
+        ]
+    return {
+        name: pack_sheet([t for f in chunks for t in f.result()], columns)
+        for name, chunks in futures.items()
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="QA contact sheets for volumes")
+    parser.add_argument("paths", nargs="+", help="volumes (.mha or .vtk)")
+    parser.add_argument(
+        "--mask",
+        action="append",
+        default=[],
+        help="mask from generate_custom_mask, once per volume in the same order",
+    )
+    parser.add_argument("--step", type=int, default=4, help="keep every Nth slice")
+    parser.add_argument("--columns", type=int, default=8)
+    parser.add_argument("--out-dir", default=".")
+    parser.add_argument("--jobs", type=int, default=None)
+    args = parser.parse_args()
+    if args.mask and len(args.mask) != len(args.paths):
+        parser.error("give one --mask per volume, or none")
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    masks = args.mask or [None] * len(args.paths)
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        for path, mask_path in zip(args.paths, masks):
+            name = os.path.splitext(os.path.basename(path))[0]
+            sheets = contact_sheets(pool, path, mask_path, args.step, args.columns)
+            for axis_name, sheet in sheets.items():
+                out_path = os.path.join(args.out_dir, f"{name}_{axis_name}.png")
+                write_png(sheet, out_path)
+                print(out_path)
@@ -0,0 +1,331 @@
+import argparse
+import json
+import math
+import os
+import zlib
+
+import numpy as np
+
+from datasets import THIN_AXIS_RATIO
+
+"""
+    Header-only catalog of the volumes in a data directory.
+    MetaImage (.mha/.mhd) and legacy VTK (.vtk) headers are parsed without
+    reading the voxels, and the dimensions, element type, spacing and
+    compression of every file are kept in a JSON index next to the data.
+    A refresh only re-parses files whose mtime or size changed. Thumbnails
+    read a single slice: a seek for raw data, a partial inflate for
+    compressed data.
+"""
+
+CATALOG_EXTENSIONS = (".mha", ".mhd", ".vtk")
+CATALOG_INDEX_NAME = ".dataset_catalog.json"
+CATALOG_VERSION = 1
+THUMBNAIL_SIZE = 128
+INFLATE_CHUNK = 1 << 16
+
+MET_DTYPES = {
+    "MET_CHAR": "i1",
+    "MET_UCHAR": "u1",
+    "MET_SHORT": "i2",
+    "MET_USHORT": "u2",
+    "MET_INT": "i4",
+    "MET_UINT": "u4",
+    "MET_LONG": "i4",
+    "MET_ULONG": "u4",
+    "MET_LONG_LONG": "i8",
+    "MET_ULONG_LONG": "u8",
+    "MET_FLOAT": "f4",
+    "MET_DOUBLE": "f8",
+}
+VTK_DTYPES = {
+    "char": "i1",
+    "unsigned_char": "u1",
+    "short": "i2",
+    "unsigned_short": "u2",
+    "int": "i4",
+    "unsigned_int": "u4",
+    "long": "i8",
+    "unsigned_long": "u8",
+    "vtktypeint64": "i8",
+    "vtktypeuint64": "u8",
+    "float": "f4",
+    "double": "f8",
+}
+
+
+def read_metaimage_header(path):
+    fields = {}
+    with open(path, "rb") as f:
+        while True:
+            line = f.readline()
+            if not line:
+                raise ValueError(f"{path}: no ElementDataFile in the header")
+            key, _, value = line.decode("latin-1").partition("=")
+            fields[key.strip()] = value.strip()
+            if key.strip() == "ElementDataFile":
+                header_bytes = f.tell()
+                break
+
+    dims = [int(v) for v in fields["DimSize"].split()]
+    spacing = fields.get("ElementSpacing") or fields.get("ElementSize")
+    origin = fields.get("Offset") or fields.get("Origin") or fields.get("Position")
+    msb = fields.get(
+        "BinaryDataByteOrderMSB", fields.get("ElementByteOrderMSB", "False")
+    )
+    data_file = fields["ElementDataFile"]
+    if data_file == "LOCAL":
+        data_file, data_offset = None, header_bytes
+    else:
+        # Detached data (.mhd + .raw); HeaderSize -1 means "at the end"
+        data_offset = int(fields.get("HeaderSize", 0))
+    return {
+        "format": "MetaImage",
+        "dims": dims,
+        "element_type": fields["ElementType"],
+        "dtype": (">" if msb.lower() == "true" else "<")
+        + MET_DTYPES[fields["ElementType"]],
+        "components": int(fields.get("ElementNumberOfChannels", 1)),
+        "spacing": [float(v) for v in spacing.split()] if spacing else [1.0] * 3,
+        "origin": [float(v) for v in origin.split()] if origin else [0.0] * 3,
+        "binary": fields.get("BinaryData", "True").lower() == "true",
+        "compressed": fields.get("CompressedData", "False").lower() == "true",
+        "data_file": data_file,
+        "data_offset": data_offset,
+    }
+
+
+def read_vtk_header(path):
+    # Legacy VTK: 2 header lines, ASCII/BINARY, DATASET, then the geometry
+    # up to the first point scalars
+    header = {
+        "format": "VTK",
+        "dims": None,
+        "element_type": None,
+        "dtype": None,
+        "components": 1,
+        "spacing": [1.0] * 3,
+        "origin": [0.0] * 3,
+        "compressed": False,
+        "data_file": None,
+        "data_offset": None,
+    }
+    with open(path, "rb") as f:
+        if not f.readline().startswith(b"# vtk DataFile"):
+            raise ValueError(f"{path} is not a legacy VTK file")
+        f.readline()  # title
+        header["binary"] = f.readline().strip().upper() == b"BINARY"
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            words = line.decode("latin-1").split()
+            if not words:
+                continue
+            keyword = words[0].upper()
+            if keyword == "DATASET":
+                header["dataset"] = words[1]
+                if words[1].upper() != "STRUCTURED_POINTS":
+                    break
+            elif keyword == "DIMENSIONS":
+                header["dims"] = [int(v) for v in words[1:4]]
+            elif keyword in ("SPACING", "ASPECT_RATIO"):
+                header["spacing"] = [float(v) for v in words[1:4]]
+            elif keyword == "ORIGIN":
+                header["origin"] = [float(v) for v in words[1:4]]
+            elif keyword == "SCALARS":
+                header["element_type"] = words[2]
+                header["dtype"] = ">" + VTK_DTYPES[words[2].lower()]
+                if len(words) > 3:
+                    header["components"] = int(words[3])
+            elif keyword == "LOOKUP_TABLE":
+                header["data_offset"] = f.tell()
+                break
+            elif keyword in ("CELL_DATA", "FIELD"):
+                break
+    return header
+
+
+def read_header(path):
+    if path.endswith(".vtk"):
+        return read_vtk_header(path)
+    return read_metaimage_header(path)
+
+
+def _inflate_prefix(f, size):
+    # First size bytes of a zlib stream, inflating no further than needed
+    inflater = zlib.decompressobj()
+    pieces, produced = [], 0
+    while produced < size:
+        compressed = inflater.unconsumed_tail or f.read(INFLATE_CHUNK)
+        if not compressed:
+            break
+        pieces.append(inflater.decompress(compressed, size - produced))
+        produced += len(pieces[-1])
+    return b"".join(pieces)
+
+
+def thumbnail_axis(dims):
+    # numpy axis of the (z, y, x) volume the thumbnail cuts across: the thin
+    # axis of a stack of 2D images, otherwise z
+    smallest = int(np.argmin(dims))
+    if dims[smallest] < THIN_AXIS_RATIO * max(dims):
+        return 2 - smallest
+    return 0
+
+
+def read_thumbnail(path, header, size=THUMBNAIL_SIZE):
+    # Middle slice as a (rows, columns) uint8 image of at most size pixels a
+    # side, or None for data that cannot be sliced from the file without
+    # reading all of it
+    dims = header["dims"]
+    if (
+        dims is None
+        or len(dims) != 3
+        or header["dtype"] is None
+        or header["data_offset"] is None
+        or not header.get("binary", True)
+    ):
+        return None
+    dtype = np.dtype(header["dtype"])
+    shape = (dims[2], dims[1], dims[0], header["components"])
+    axis = thumbnail_axis(dims)
+    middle = shape[axis] // 2
+    data_path = path
+    if header["data_file"] is not None:
+        data_path = os.path.join(os.path.dirname(path), header["data_file"])
+    offset = header["data_offset"]
+    if offset < 0:
+        offset = os.path.getsize(data_path) - math.prod(shape) * dtype.itemsize
+
+    if header["compressed"]:
+        # Only the stream up to the end of the slice is inflated, which needs a
+        # cut across z; any other cut would inflate the whole volume
+        if axis != 0:
+            return None
+        count = math.prod(shape[1:]) * (middle + 1)
+        with open(data_path, "rb") as f:
+            f.seek(offset)
+            data = _inflate_prefix(f, count * dtype.itemsize)
+        volume = np.frombuffer(data, dtype=dtype).reshape((-1,) + shape[1:])
+    else:
+        volume = np.memmap(data_path, dtype, "r", offset, shape)
+    plane = np.take(volume, middle, axis=axis)[..., 0]
+
+    step = max(math.ceil(max(plane.shape) / size), 1)
+    plane = np.asarray(plane[::step, ::step], dtype=np.float64)
+    low, high = plane.min(), plane.max()
+    if high <= low:
+        return np.zeros(plane.shape, dtype=np.uint8)
+    return ((plane - low) * (255 / (high - low))).astype(np.uint8)
+
+
+class DatasetCatalog:
+    def __init__(self, root, index_path=None):
+        self.root = os.path.abspath(root)
+        self.index_path = index_path or os.path.join(self.root, CATALOG_INDEX_NAME)
+        self.entries = {}
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+            if index.get("version") == CATALOG_VERSION:
+                self.entries = index["entries"]
+        except (OSError, ValueError):
+            pass
+
+    def scan(self):
+        # Relative paths of the catalogued files under root
+        paths = []
+        for directory, subdirectories, files in os.walk(self.root):
+            subdirectories[:] = sorted(d for d in subdirectories if d[0] != ".")
+            for name in sorted(files):
+                if name.lower().endswith(CATALOG_EXTENSIONS):
+                    paths.append(
+                        os.path.relpath(os.path.join(directory, name), self.root)
+                    )
+        return paths
+
+    def refresh(self):
+        # Re-parses new or modified files only; returns the paths that changed
+        changed = []
+        present = set()
+        for relative in self.scan():
+            present.add(relative)
+            stat = os.stat(os.path.join(self.root, relative))
+            entry = self.entries.get(relative)
+            if (
+                entry
+                and entry["mtime"] == stat.st_mtime
+                and entry["size"] == stat.st_size
+            ):
+                continue
+            try:
+                entry = read_header(os.path.join(self.root, relative))
+            except (ValueError, KeyError, IndexError) as e:
+                entry = {"error": str(e)}
+            entry.update(mtime=stat.st_mtime, size=stat.st_size)
+            self.entries[relative] = entry
+            changed.append(relative)
+        removed = set(self.entries) - present
+        for relative in removed:
+            del self.entries[relative]
+        if changed or removed:
+            self.save()
+        return changed
+
+    def save(self):
+        index = {"version": CATALOG_VERSION, "entries": self.entries}
+        try:
+            with open(self.index_path, "w") as f:
+                json.dump(index, f, indent=1)
+        except OSError:
+            # Read-only data directories are simply re-scanned next time
+            pass
+
+    def path(self, relative):
+        return os.path.join(self.root, relative)
+
+    def thumbnail(self, relative, size=THUMBNAIL_SIZE):
+        entry = self.entries[relative]
+        if "error" in entry:
+            return None
+        return read_thumbnail(self.path(relative), entry, size)
+
+
+def describe_entry(entry):
+    if "error" in entry:
+        return f"unreadable: {entry['error']}"
+    dims = "x".join(str(d) for d in entry["dims"]) if entry["dims"] else "?"
+    spacing = " ".join(f"{s:g}" for s in entry["spacing"])
+    channels = f" x{entry['components']}" if entry["components"] > 1 else ""
+    compressed = ", compressed" if entry["compressed"] else ""
+    return (
+        f"{dims} {entry['element_type']}{channels}, spacing {spacing}, "
+        f"{entry['size'] / 2**20:.1f} MiB{compressed}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Catalog the volumes in a folder")
+    parser.add_argument("root", nargs="?", default="data")
+    parser.add_argument("--thumbnails", help="write a PNG thumbnail per file here")
+    args = parser.parse_args()
+
+    catalog = DatasetCatalog(args.root)
+    changed = catalog.refresh()
+    print(f"{len(catalog.entries)} files, {len(changed)} (re)parsed")
+    for relative, entry in sorted(catalog.entries.items()):
+        print(f"{relative}: {describe_entry(entry)}")
+
+    if args.thumbnails:
+        from contact_sheet import write_png
+
+        os.makedirs(args.thumbnails, exist_ok=True)
+        for relative in sorted(catalog.entries):
+            thumbnail = catalog.thumbnail(relative)
+            if thumbnail is not None:
+                name = os.path.splitext(relative.replace(os.sep, "_"))[0] + ".png"
+                write_png(
+                    np.repeat(thumbnail[..., None], 3, axis=2),
+                    os.path.join(args.thumbnails, name),
+                )
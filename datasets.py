@@ -0,0 +1,17 @@
+import os
+
+"""
+    Where the bundled volumes live, and layout constants shared by the
+    command line tools, the dataset catalog and the viewers.
+"""
+
+DATA_DIR = os.environ.get(
+    "VIS_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+)
+BUNDLED_VOLUMES = [
+    os.path.join(DATA_DIR, "BRATS_HG0015_T1C.mha"),
+    os.path.join(DATA_DIR, "braintumor_image.mha"),
+]
+# A volume with an axis this much thinner than the largest one (e.g. a stack
+# of 3 images) is a stack of 2D images rather than one connected volume
+THIN_AXIS_RATIO = 0.25
@@ -0,0 +1,212 @@
+import argparse
+
+import itk
+
+from execution_config import configure_stage
+
+"""
+    Pixel type planning for the segmentation chain.
+    Every stage gets the narrowest pixel type that is wrapped by ITK and can
+    hold the values it produces, and the bytes each stage allocates are
+    recorded so the memory footprint of the chain can be measured.
+"""
+
+# Wrapped integer pixel types, narrowest first
+INTEGER_PIXEL_TYPES = [itk.UC, itk.US, itk.SS, itk.UL]
+# Output pixel types ConnectedComponentImageFilter is wrapped for
+LABEL_PIXEL_TYPES = [itk.US, itk.UL]
+# Pixel types LabelShapeKeepNObjectsImageFilter is wrapped for
+SHAPE_PIXEL_TYPES = [itk.UC, itk.US, itk.SS]
+
+
+def image_type(image):
+    # (pixel type, dimension) of an image or of a filter's output
+    if hasattr(image, "GetOutput"):
+        image = image.GetOutput()
+    return itk.template(image)[1]
+
+
+def pixel_type(image):
+    return image_type(image)[0]
+
+
+def image_bytes(image):
+    # Bytes held by the buffered region of an image
+    region = image.GetBufferedRegion()
+    return region.GetNumberOfPixels() * pixel_type(image).dtype.itemsize
+
+
+def narrowest_pixel_type(low, high, candidates=INTEGER_PIXEL_TYPES):
+    for candidate in candidates:
+        if (
+            itk.NumericTraits[candidate].min() <= low
+            and high <= itk.NumericTraits[candidate].max()
+        ):
+            return candidate
+    raise ValueError(f"No pixel type in {candidates} holds [{low}, {high}]")
+
+
+def record_stage(report, name, image, in_place=False):
+    if report is not None:
+        report.append(
+            {
+                "stage": name,
+                "pixel_type": pixel_type(image).short_name,
+                "bytes": 0 if in_place else image_bytes(image),
+            }
+        )
+
+
+def planned_rescale(image, output_minimum, output_maximum, intensity_range=None):
+    # With a known input range the same linear map is applied by an
+    # IntensityWindowingImageFilter, which gives identical voxels but does not
+    # depend on the region it is asked for (so it can be streamed)
+    in_type, dim = image_type(image)
+    out_type = narrowest_pixel_type(output_minimum, output_maximum)
+    types = (itk.Image[in_type, dim], itk.Image[out_type, dim])
+    if intensity_range is None:
+        rescale = itk.RescaleIntensityImageFilter[types].New(
+            Input=image, OutputMinimum=output_minimum, OutputMaximum=output_maximum
+        )
+    else:
+        rescale = itk.IntensityWindowingImageFilter[types].New(
+            Input=image,
+            WindowMinimum=intensity_range[0],
+            WindowMaximum=intensity_range[1],
+            OutputMinimum=output_minimum,
+            OutputMaximum=output_maximum,
+        )
+    return configure_stage("rescale", rescale)
+
+
+def planned_threshold(image, lower):
+    # Same pixel type as the input, so the filter can reuse its buffer
+    threshold = itk.ThresholdImageFilter.New(Input=image, Lower=lower, InPlace=True)
+    return configure_stage("threshold", threshold)
+
+
+def planned_connected_components(image):
+    in_type, dim = image_type(image)
+    for out_type in LABEL_PIXEL_TYPES:
+        connected_components = itk.ConnectedComponentImageFilter[
+            itk.Image[in_type, dim], itk.Image[out_type, dim]
+        ].New(Input=image)
+        configure_stage("connected_components", connected_components)
+        try:
+            connected_components.Update()
+            return connected_components
+        except RuntimeError:
+            # More components than the label type can count
+            continue
+    raise ValueError("Too many connected components for any label type")
+
+
+def compact_labels(labels, object_count):
+    # Labels are consecutive, so the object count bounds the label values
+    in_type, dim = image_type(labels)
+    out_type = narrowest_pixel_type(0, object_count, SHAPE_PIXEL_TYPES)
+    if out_type == in_type:
+        return None
+    cast = itk.CastImageFilter[itk.Image[in_type, dim], itk.Image[out_type, dim]].New(
+        Input=labels
+    )
+    return configure_stage("compact_labels", cast)
+
+
+def binary_mask(image):
+    # Labels > 0 straight to a 0/1 uchar mask
+    in_type, dim = image_type(image)
+    mask = itk.BinaryThresholdImageFilter[
+        itk.Image[in_type, dim], itk.Image[itk.UC, dim]
+    ].New(Input=image, LowerThreshold=1, InsideValue=1, OutsideValue=0)
+    return configure_stage("mask", mask)
+
+
+def original_chain_report(path, lower=102, filters=()):
+    # Bytes allocated by the chain sample.py used before the planner
+    report = []
+    mri = itk.imread(path)
+    record_stage(report, "read", mri)
+    rescaled_mri = itk.RescaleIntensityImageFilter.New(
+        Input=mri, OutputMinimum=0, OutputMaximum=255
+    )
+    rescaled_mri.Update()
+    record_stage(report, "rescale", rescaled_mri.GetOutput())
+    binary_image = itk.ThresholdImageFilter.New(Input=rescaled_mri, Lower=lower)
+    binary_image.Update()
+    record_stage(report, "threshold", binary_image.GetOutput())
+    connected_components = itk.ConnectedComponentImageFilter.New(Input=binary_image)
+    connected_components.Update()
+    record_stage(report, "connected_components", connected_components.GetOutput())
+    history = [connected_components]
+    for i, (attribute, number, reverse) in enumerate(filters):
+        history.append(
+            itk.LabelShapeKeepNObjectsImageFilter.New(
+                Input=history[-1],
+                BackgroundValue=0,
+                NumberOfObjects=number,
+                Attribute=attribute,
+                ReverseOrdering=reverse,
+            )
+        )
+        history[-1].Update()
+        record_stage(report, f"keep_objects_{i}", history[-1].GetOutput())
+    mask = itk.NotImageFilter.New(Input=history[-1])
+    mask.Update()
+    record_stage(report, "not", mask.GetOutput())
+    mask_not = itk.NotImageFilter.New(Input=mask)
+    mask_not.Update()
+    record_stage(report, "not", mask_not.GetOutput())
+    converted = itk.CastImageFilter[itk.Image[itk.SS, 3], itk.Image[itk.UC, 3]].New(
+        Input=mask_not
+    )
+    converted.Update()
+    record_stage(report, "cast", converted.GetOutput())
+    result_image = itk.RescaleIntensityImageFilter.New(
+        Input=converted, OutputMinimum=0, OutputMaximum=1
+    )
+    result_image.Update()
+    record_stage(report, "mask_rescale", result_image.GetOutput())
+    return report
+
+
+def format_report(report):
+    lines = [f"{'stage':<24}{'pixel':>8}{'MiB':>10}"]
+    for row in report:
+        mib = row["bytes"] / 2**20
+        lines.append(f"{row['stage']:<24}{row['pixel_type']:>8}{mib:>10.2f}")
+    total = sum(row["bytes"] for row in report) / 2**20
+    lines.append(f"{'total':<24}{'':>8}{total:>10.2f}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    from sample import (
+        CUSTOM_FILTERS,
+        MRI_FILE_PATH,
+        custom_morpho_filters,
+        generate_custom_mask,
+        segment_connected_components,
+    )
+
+    parser = argparse.ArgumentParser(description="Per-stage memory of the pipeline")
+    parser.add_argument("path", nargs="?", default=MRI_FILE_PATH)
+    args = parser.parse_args()
+
+    print("Original chain")
+    print(format_report(original_chain_report(args.path, filters=CUSTOM_FILTERS)))
+
+    planned_report = []
+    connected_components = segment_connected_components(
+        args.path, report=planned_report
+    )
+    cc_filters_result = custom_morpho_filters(
+        connected_components, filters=CUSTOM_FILTERS
+    )
+    for i, stage in enumerate(cc_filters_result[1:]):
+        stage.Update()
+        record_stage(planned_report, f"keep_objects_{i}", stage.GetOutput())
+    custom_mask = generate_custom_mask(cc_filters_result[-1])
+    record_stage(planned_report, "mask", custom_mask.GetOutput())
+    print("\nPlanned chain")
+    print(format_report(planned_report))
@@ -0,0 +1,126 @@
+import os
+
+import vtk
+import itk
+
+"""
+    Thread configuration for the ITK filters and VTK algorithms.
+    One ExecutionConfig sets the global thread counts of ITK (pool threader),
+    VTK (vtkMultiThreader, vtkSMPTools) and optionally pins the process to a
+    set of cores, so several sessions / batch jobs on one node can share it
+    without oversubscribing. Stages can get their own thread counts.
+"""
+
+# Stage names used with configure_stage()
+STAGES = [
+    "rescale",
+    "threshold",
+    "connected_components",
+    "compact_labels",
+    "keep_objects",
+    "mask",
+    "refine",
+    "slices",
+    "render",
+]
+
+_active_config = None
+
+
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def parse_cores(text):
+    # "0-3,6" -> [0, 1, 2, 3, 6]
+    cores = []
+    for part in text.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cores.extend(range(int(first), int(last) + 1))
+        elif part:
+            cores.append(int(part))
+    return cores
+
+
+def parse_stage_threads(text):
+    # "connected_components=2,keep_objects=4" -> {stage: threads}
+    stage_threads = {}
+    for part in filter(None, text.split(",")):
+        stage, threads = part.split("=")
+        if stage not in STAGES:
+            raise ValueError(
+                f"stage='{stage}' is not a valid stage. Valid values are: {STAGES}"
+            )
+        stage_threads[stage] = int(threads)
+    return stage_threads
+
+
+class ExecutionConfig:
+    def __init__(self, threads=None, stage_threads=None, pin_cores=None):
+        self.pin_cores = pin_cores
+        cores = pin_cores if pin_cores else available_cores()
+        self.threads = threads or len(cores)
+        self.stage_threads = dict(stage_threads or {})
+
+    @classmethod
+    def from_env(cls):
+        # VIS_THREADS=4 VIS_STAGE_THREADS=connected_components=2 VIS_PIN_CORES=0-3
+        return cls(
+            threads=int(os.environ.get("VIS_THREADS", 0)) or None,
+            stage_threads=parse_stage_threads(os.environ.get("VIS_STAGE_THREADS", "")),
+            pin_cores=parse_cores(os.environ.get("VIS_PIN_CORES", "")) or None,
+        )
+
+    def threads_for(self, stage):
+        return self.stage_threads.get(stage, self.threads)
+
+    def apply(self):
+        # Must run before the first filter executes: ITK's thread pool and
+        # VTK's SMP backend are sized on first use, and pinning only applies
+        # to threads started afterwards
+        global _active_config
+        if self.pin_cores and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, self.pin_cores)
+
+        max_threads = max([self.threads] + list(self.stage_threads.values()))
+        itk.MultiThreaderBase.SetGlobalMaximumNumberOfThreads(max_threads)
+        itk.MultiThreaderBase.SetGlobalDefaultNumberOfThreads(self.threads)
+
+        vtk.vtkMultiThreader.SetGlobalMaximumNumberOfThreads(max_threads)
+        vtk.vtkMultiThreader.SetGlobalDefaultNumberOfThreads(self.threads)
+        if self.threads > 1 and vtk.vtkSMPTools.GetBackend() == "Sequential":
+            vtk.vtkSMPTools.SetBackend("STDThread")
+        vtk.vtkSMPTools.Initialize(self.threads)
+
+        _active_config = self
+        return self
+
+    def describe(self):
+        pinned = f", pinned to cores {self.pin_cores}" if self.pin_cores else ""
+        stages = "".join(f", {s}={n}" for s, n in self.stage_threads.items())
+        return f"{self.threads} threads{stages}{pinned}"
+
+
+def stage_thread_count(stage):
+    # Threads for a stage run by our own code (numpy kernels) instead of a
+    # filter; all available cores when no config was applied
+    if _active_config is None:
+        return len(available_cores())
+    return _active_config.threads_for(stage)
+
+
+def configure_stage(stage, algorithm):
+    # Applies the active config's thread count for stage to an ITK filter or
+    # a threaded VTK algorithm / mapper; a no-op when no config was applied
+    if _active_config is None:
+        return algorithm
+    threads = _active_config.threads_for(stage)
+    if hasattr(algorithm, "SetNumberOfWorkUnits"):
+        algorithm.GetMultiThreader().SetMaximumNumberOfThreads(threads)
+        algorithm.SetNumberOfWorkUnits(threads)
+    elif hasattr(algorithm, "SetNumberOfThreads"):
+        algorithm.SetNumberOfThreads(threads)
+    return algorithm
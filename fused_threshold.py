@@ -0,0 +1,162 @@
+import argparse
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import itk
+
+from datasets import BUNDLED_VOLUMES
+from dtype_planner import (
+    image_bytes,
+    image_type,
+    planned_connected_components,
+    planned_rescale,
+    planned_threshold,
+)
+from execution_config import stage_thread_count
+
+"""
+    Fused rescale + threshold + binarize.
+    Rescaling to 0..255 and keeping voxels >= 102 only decides which raw
+    voxels are foreground, so the same decision is made with one comparison
+    of the raw voxels against the equivalent raw cut-off. The comparison runs
+    slab by slab on a thread pool (numpy releases the GIL) and writes a 0/1
+    uchar image that goes straight into connected components: one read of
+    the input and one write of the output instead of a full rescaled copy.
+"""
+
+FUSED_SLAB_SLICES = 8
+
+
+def fusable(image):
+    # The raw cut-off is exact for integer voxels only
+    return np.issubdtype(image_type(image)[0].dtype, np.integer)
+
+
+def raw_cutoff(intensity_range, lower, output_minimum=0, output_maximum=255):
+    # Smallest raw value that IntensityWindowingImageFilter (see
+    # planned_rescale) maps to >= lower, using the filter's own double
+    # arithmetic; high + 1 when no value reaches it
+    low, high = (int(v) for v in intensity_range)
+    if high <= low:
+        return high + 1
+    scale = (float(output_maximum) - float(output_minimum)) / (float(high) - low)
+    shift = float(output_minimum) - low * scale
+
+    def foreground(x):
+        # The filter truncates to the output type, lower is an integer
+        return x > high or (x >= low and x * scale + shift >= lower)
+
+    cutoff = min(max(math.ceil((lower - shift) / scale), low), high + 1)
+    while cutoff > low and foreground(cutoff - 1):
+        cutoff -= 1
+    while cutoff <= high and not foreground(cutoff):
+        cutoff += 1
+    return cutoff
+
+
+def fused_threshold(image, cutoff, slab_slices=FUSED_SLAB_SLICES, threads=None):
+    # 0/1 uchar image of raw voxels >= cutoff, on the grid of image
+    dim = image.GetImageDimension()
+    output = itk.Image[itk.UC, dim].New()
+    output.CopyInformation(image)
+    output.SetRegions(image.GetBufferedRegion())
+    output.Allocate()
+
+    raw = itk.array_view_from_image(image)
+    binary = itk.array_view_from_image(output)
+    if cutoff > np.iinfo(raw.dtype).max:
+        binary.fill(0)
+        return output
+
+    def run(z0):
+        np.greater_equal(
+            raw[z0 : z0 + slab_slices], cutoff, out=binary[z0 : z0 + slab_slices]
+        )
+
+    threads = threads or stage_thread_count("threshold")
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(run, range(0, raw.shape[0], slab_slices)))
+    return output
+
+
+def filter_chain_binary(image, intensity_range, lower):
+    # Foreground of the planned rescale + threshold filters (the reference)
+    # The in-place threshold takes over the rescale's buffer, so the rescale
+    # is kept referenced until the threshold has run
+    rescale = planned_rescale(image, 0, 255, intensity_range)
+    threshold = planned_threshold(rescale, lower=lower)
+    threshold.Update()
+    output = threshold.GetOutput()
+    output.DisconnectPipeline()
+    return output
+
+
+def verify(path, lower=102, repeats=3):
+    # Compares the fused kernel with the filter chain on one volume
+    from sample import image_intensity_range
+
+    mri = itk.imread(path)
+    intensity_range = image_intensity_range(mri)
+    cutoff = raw_cutoff(intensity_range, lower)
+
+    def timed(run):
+        times = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            result = run()
+            times.append(time.perf_counter() - started)
+        return result, min(times)
+
+    reference, chain_seconds = timed(
+        lambda: filter_chain_binary(mri, intensity_range, lower)
+    )
+    fused, fused_seconds = timed(lambda: fused_threshold(mri, cutoff))
+
+    reference_array = itk.array_view_from_image(reference) != 0
+    fused_array = itk.array_view_from_image(fused) != 0
+    mismatches = int(np.count_nonzero(reference_array != fused_array))
+    reference_count = planned_connected_components(reference).GetObjectCount()
+    fused_count = planned_connected_components(fused).GetObjectCount()
+
+    # Bytes read + written by the pre-labelling stages: the chain reads the
+    # raw voxels, writes the rescaled copy, then thresholds it in place
+    raw_bytes = image_bytes(mri)
+    chain_traffic = raw_bytes + 3 * image_bytes(reference)
+    fused_traffic = raw_bytes + image_bytes(fused)
+    return {
+        "path": path,
+        "cutoff": cutoff,
+        "mismatches": mismatches,
+        "components": (reference_count, fused_count),
+        "seconds": (chain_seconds, fused_seconds),
+        "traffic": (chain_traffic, fused_traffic),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check the fused threshold against the rescale + threshold filters"
+    )
+    parser.add_argument("paths", nargs="*", default=BUNDLED_VOLUMES)
+    parser.add_argument("--lower", type=int, default=102)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    failed = False
+    for path in args.paths:
+        result = verify(path, args.lower, args.repeats)
+        chain_seconds, fused_seconds = result["seconds"]
+        chain_traffic, fused_traffic = result["traffic"]
+        ok = result["mismatches"] == 0 and len(set(result["components"])) == 1
+        failed = failed or not ok
+        print(
+            f"{os.path.basename(path)}: {'OK' if ok else 'MISMATCH'} "
+            f"cutoff={result['cutoff']} mismatched voxels={result['mismatches']} "
+            f"components={result['components'][0]}/{result['components'][1]}\n"
+            f"  filters {chain_seconds * 1000:8.1f} ms {chain_traffic / 2**20:8.1f} MiB"
+            f"\n  fused   {fused_seconds * 1000:8.1f} ms {fused_traffic / 2**20:8.1f} MiB"
+        )
+    raise SystemExit(1 if failed else 0)
@@ -0,0 +1,271 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+"""
+    Record / replay of interactive sessions for latency regression checks.
+    Interaction events (slider values, checkbox toggles, file opens, keys) are
+    recorded as JSON lines with timestamps. A replay dispatches them through
+    the same widgets with offscreen rendering, times each event up to its
+    frame, and reports p50/p95/p99 per event against a stored baseline.
+"""
+
+PERCENTILES = (50, 95, 99)
+DEFAULT_TOLERANCE = 0.25
+# Regressions smaller than this are treated as noise
+MIN_REGRESSION_SECONDS = 0.002
+
+
+class Recorder:
+    def __init__(self, path, app):
+        self.app = app
+        self._file = open(path, "w", buffering=1)
+        self._started = time.perf_counter()
+        self._suppressed = False
+
+    def record(self, event, **args):
+        if self._suppressed:
+            return
+        entry = {"t": time.perf_counter() - self._started, "app": self.app}
+        entry.update(event=event, args=args)
+        self._file.write(json.dumps(entry) + "\n")
+
+    def attach_slider(self, slider_widget, name, integer_steps=False):
+        # sample.py vtkSliderWidget (see AddCustomSlider)
+        def on_interaction(widget, event):
+            value = widget.GetSliderRepresentation().GetValue()
+            self.record(
+                "slider", name=name, value=round(value) if integer_steps else value
+            )
+
+        slider_widget.AddObserver("InteractionEvent", on_interaction)
+
+    def attach_keys(self, interactor):
+        interactor.AddObserver(
+            "KeyPressEvent", lambda i, e: self.record("key", key=i.GetKeySym())
+        )
+
+    def attach_qt(self, window):
+        # sample2.py MainWindow: every ui_* slider, spin box and check box, and
+        # the Open button. Values open_vtk_file sets itself are not recorded,
+        # the replayed open sets them again.
+        from PyQt5 import Qt
+
+        def on_open_pressed():
+            self.record("open", path=window.ui_file_name.text())
+            self._suppressed = True
+
+        def on_open_clicked():
+            # Connected after open_vtk_file, so it runs once the open is done
+            self._suppressed = False
+
+        for name, widget in vars(window).items():
+            if not name.startswith("ui_"):
+                continue
+            if isinstance(widget, Qt.QCheckBox):
+                widget.toggled.connect(
+                    lambda checked, name=name: self.record(
+                        "checkbox", name=name, checked=checked
+                    )
+                )
+            elif isinstance(widget, (Qt.QSlider, Qt.QDoubleSpinBox, Qt.QSpinBox)):
+                widget.valueChanged.connect(
+                    lambda value, name=name: self.record(
+                        "value", name=name, value=value
+                    )
+                )
+        window.ui_open_button.pressed.connect(on_open_pressed)
+        window.ui_open_button.clicked.connect(on_open_clicked)
+
+    def close(self):
+        self._file.close()
+
+
+def read_events(path, app=None):
+    with open(path) as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    if app is not None:
+        events = [e for e in events if e["app"] == app]
+    return events
+
+
+def event_key(event):
+    # Latencies are grouped per event kind and widget
+    name = event["args"].get("name") or event["args"].get("key")
+    return f"{event['event']}:{name}" if name else event["event"]
+
+
+def replay(events, dispatch, render, realtime=False):
+    # dispatch(event) runs the handlers, render() produces the frame.
+    # Returns the latencies and the exceptions raised in callbacks: VTK
+    # observers and Qt slots only print those (through sys.excepthook), so
+    # they are counted here instead of passing unnoticed
+    latencies = {}
+    errors = []
+    excepthook = sys.excepthook
+
+    def count_exception(kind, value, traceback):
+        errors.append(f"{kind.__name__}: {value}")
+        excepthook(kind, value, traceback)
+
+    sys.excepthook = count_exception
+    try:
+        started = time.perf_counter()
+        for event in events:
+            if realtime:
+                delay = event["t"] - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            event_started = time.perf_counter()
+            dispatch(event)
+            render()
+            latencies.setdefault(event_key(event), []).append(
+                time.perf_counter() - event_started
+            )
+    finally:
+        sys.excepthook = excepthook
+    return latencies, errors
+
+
+def latency_report(latencies):
+    report = {}
+    for key, samples in latencies.items():
+        values = np.percentile(samples, PERCENTILES)
+        report[key] = {"count": len(samples)}
+        report[key].update({f"p{p}": float(v) for p, v in zip(PERCENTILES, values)})
+    return report
+
+
+def compare_to_baseline(report, baseline, tolerance=DEFAULT_TOLERANCE):
+    # Percentiles slower than the baseline by more than tolerance (relative)
+    regressions = []
+    for key, row in report.items():
+        if key not in baseline:
+            continue
+        for p in PERCENTILES:
+            current, reference = row[f"p{p}"], baseline[key][f"p{p}"]
+            if (
+                current > reference * (1 + tolerance)
+                and current - reference > MIN_REGRESSION_SECONDS
+            ):
+                regressions.append(
+                    f"{key} p{p}: {current * 1000:.1f} ms vs baseline "
+                    f"{reference * 1000:.1f} ms"
+                )
+    return regressions
+
+
+def format_report(report):
+    lines = [
+        f"{'event':<32}{'n':>5}" + "".join(f"{f'p{p} ms':>10}" for p in PERCENTILES)
+    ]
+    for key, row in sorted(report.items()):
+        lines.append(
+            f"{key:<32}{row['count']:>5}"
+            + "".join(f"{row[f'p{p}'] * 1000:>10.1f}" for p in PERCENTILES)
+        )
+    return "\n".join(lines)
+
+
+def finish_replay(
+    report, baseline_path=None, save_baseline=None, tolerance=None, errors=()
+):
+    # Prints the report, handles baselines and returns the exit status; a
+    # replay with errors (callback exceptions, failed worker requests) fails
+    # whatever its latencies
+    print(format_report(report))
+    if errors:
+        print(f"ERROR {len(errors)} errors during the replay:")
+        for text in sorted(set(errors)):
+            print(f"  {errors.count(text)} x {text}")
+        return 1
+    if save_baseline:
+        with open(save_baseline, "w") as f:
+            json.dump(report, f, indent=2)
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(
+            report, baseline, DEFAULT_TOLERANCE if tolerance is None else tolerance
+        )
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        return 1 if regressions else 0
+    return 0
+
+
+def add_replay_arguments(parser):
+    parser.add_argument("--baseline", help="baseline latency report to compare to")
+    parser.add_argument("--save-baseline", help="write this run's report here")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument(
+        "--realtime", action="store_true", help="keep the recorded event timing"
+    )
+
+
+def replay_sample2(events, realtime=False):
+    # Headless sample2.py on the offscreen Qt platform; without a display the
+    # render window needs an offscreen VTK backend, e.g.
+    # VTK_DEFAULT_OPENGL_WINDOW=vtkEGLRenderWindow
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    import vtk
+    from PyQt5 import Qt
+    from sample2 import MainWindow
+
+    app = Qt.QApplication.instance() or Qt.QApplication(sys.argv)
+    window = MainWindow()
+    # The widget's own render window is bound to the fake window id of the
+    # offscreen platform and aborts (std::bad_alloc) on the first frames, so
+    # the renderers are moved to an unbound offscreen window
+    widget = window.vtkWidget
+    render_window = vtk.vtkRenderWindow()
+    render_window.SetOffScreenRendering(1)
+    render_window.SetSize(widget.GetRenderWindow().GetSize())
+    renderers = widget.GetRenderWindow().GetRenderers()
+    for renderer in [
+        renderers.GetItemAsObject(i) for i in range(renderers.GetNumberOfItems())
+    ]:
+        widget.GetRenderWindow().RemoveRenderer(renderer)
+        render_window.AddRenderer(renderer)
+    widget._RenderWindow = render_window
+    widget._Iren.SetRenderWindow(render_window)
+
+    def dispatch(event):
+        args = event["args"]
+        if event["event"] == "open":
+            window.ui_file_name.setText(args["path"])
+            window.ui_open_button.click()
+        elif event["event"] == "checkbox":
+            getattr(window, args["name"]).setChecked(args["checked"])
+        elif event["event"] == "value":
+            getattr(window, args["name"]).setValue(args["value"])
+        app.processEvents()
+
+    return replay(events, dispatch, render_window.Render, realtime)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay a recorded sample2.py session headlessly "
+        "(sample.py recordings are replayed with sample.py --replay)"
+    )
+    parser.add_argument("events", help="recording from VIS_RECORD=... sample2.py")
+    add_replay_arguments(parser)
+    args = parser.parse_args()
+
+    latencies, errors = replay_sample2(
+        read_events(args.events, "sample2"), args.realtime
+    )
+    sys.exit(
+        finish_replay(
+            latency_report(latencies),
+            args.baseline,
+            args.save_baseline,
+            args.tolerance,
+            errors,
+        )
+    )
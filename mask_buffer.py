@@ -0,0 +1,56 @@
+import numpy as np
+import itk
+
+from autocrop import occupied_bounds, uncrop_image
+
+"""
+    Persistent mask buffer for the volume mapper.
+    The mask handed to the mapper is allocated once; each recompute finds the
+    extent of the voxels that changed and only writes that box. Finding it
+    still compares the new labels with the whole mask, and VTK re-uploads the
+    whole mask texture when it is modified (there is no sub-region upload for
+    volume masks); what is saved is the rewrite and a new buffer per update.
+"""
+
+
+class MaskBuffer:
+    def __init__(self, reference):
+        # reference: ITK image giving the grid of the mask
+        self.array = np.zeros(tuple(itk.size(reference))[::-1], dtype=np.uint8)
+        # ITK and VTK views share self.array; nothing is copied
+        self.itk_image = itk.image_view_from_array(self.array)
+        self.itk_image.CopyInformation(reference)
+        self.image = itk.vtk_image_from_image(self.itk_image)
+
+    def changed_bounds(self, labels_array):
+        def changed_slab(z0, z1):
+            return (labels_array[z0:z1] != 0) != (self.array[z0:z1] != 0)
+
+        return occupied_bounds(self.array.shape, changed_slab)
+
+    def update(self, labels):
+        # labels: ITK image on the same grid, voxels > 0 are in the mask.
+        # Returns the VTK extent that was rewritten, or None if nothing changed
+        labels_array = itk.array_view_from_image(labels)
+        if labels_array.shape != self.array.shape:
+            raise ValueError(
+                f"labels shape={labels_array.shape} does not match "
+                f"mask shape={self.array.shape}"
+            )
+        bounds = self.changed_bounds(labels_array)
+        if bounds is None:
+            return None
+
+        (x0, y0, z0), (sx, sy, sz) = bounds
+        box = (slice(z0, z0 + sz), slice(y0, y0 + sy), slice(x0, x0 + sx))
+        self.array[box] = labels_array[box] != 0
+        self.image.GetPointData().GetScalars().Modified()
+        self.image.Modified()
+        return (x0, x0 + sx - 1, y0, y0 + sy - 1, z0, z0 + sz - 1)
+
+    def write(self, path, reference=None):
+        # Writes the mask, on the reference grid when the buffer is a crop
+        if reference is not None:
+            itk.imwrite(uncrop_image(self.itk_image, reference), path)
+        else:
+            itk.imwrite(self.itk_image, path)
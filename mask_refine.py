@@ -0,0 +1,129 @@
+import argparse
+
+import numpy as np
+import itk
+
+from autocrop import occupied_bounds
+from dtype_planner import planned_connected_components
+from execution_config import configure_stage
+
+"""
+    Morphological refinement of the selected components.
+    Closing, hole filling and opening of the binary mask, computed only
+    inside the bounding box of the selected components (padded by the
+    closing radius). Dilation and erosion by a ball are thresholds of a
+    Maurer distance map, so their cost does not depend on the radius.
+"""
+
+# Refinement applied after component selection (radii in voxels, 0 = off)
+REFINE = {"fill_holes": False, "closing_radius": 0, "opening_radius": 0}
+
+
+def _box_image(array):
+    # uchar ITK image of a (z, y, x) boolean box; spacing is not used, the
+    # radii are in voxels
+    return itk.image_from_array(np.ascontiguousarray(array, dtype=np.uint8))
+
+
+def _within(binary, radius, background):
+    # Voxels within radius of the object (the voxels != background)
+    image = _box_image(binary)
+    dim = image.GetImageDimension()
+    distance = itk.SignedMaurerDistanceMapImageFilter[
+        itk.Image[itk.UC, dim], itk.Image[itk.F, dim]
+    ].New(
+        Input=image,
+        BackgroundValue=background,
+        UseImageSpacing=False,
+        SquaredDistance=True,
+        InsideIsPositive=False,
+    )
+    configure_stage("refine", distance).Update()
+    # Inside the object the signed distance is negative
+    return itk.array_view_from_image(distance.GetOutput()) <= radius * radius
+
+
+def dilate(binary, radius):
+    return _within(binary, radius, background=0)
+
+
+def erode(binary, radius):
+    # Voxels further than radius from the background
+    return ~_within(binary, radius, background=1)
+
+
+def fill_holes(binary):
+    fill = itk.BinaryFillholeImageFilter.New(
+        Input=_box_image(binary), ForegroundValue=1, FullyConnected=False
+    )
+    configure_stage("refine", fill).Update()
+    return itk.array_view_from_image(fill.GetOutput()) != 0
+
+
+def refine_box(binary, fill=False, closing_radius=0, opening_radius=0):
+    # Closing bridges gaps, hole filling removes enclosed cavities and
+    # opening removes thin bridges / spurs
+    if closing_radius > 0:
+        binary = erode(dilate(binary, closing_radius), closing_radius)
+    if fill:
+        binary = fill_holes(binary)
+    if opening_radius > 0:
+        binary = dilate(erode(binary, opening_radius), opening_radius)
+    return binary
+
+
+def refine_mask(labels, fill_holes=False, closing_radius=0, opening_radius=0):
+    # labels: ITK label image, voxels > 0 are selected. Returns a 0/1 uchar
+    # image on the same grid, refined inside the box of the selection
+    # (labels itself when no refinement is asked for)
+    closing_radius, opening_radius = int(closing_radius), int(opening_radius)
+    if not (fill_holes or closing_radius > 0 or opening_radius > 0):
+        return labels
+    dim = labels.GetImageDimension()
+    mask = itk.Image[itk.UC, dim].New()
+    mask.CopyInformation(labels)
+    mask.SetRegions(labels.GetBufferedRegion())
+    mask.Allocate()
+    mask_array = itk.array_view_from_image(mask)
+    np.not_equal(itk.array_view_from_image(labels), 0, out=mask_array)
+
+    # One voxel more than the closing can grow, so the box keeps a
+    # background border and enclosed holes stay enclosed
+    bounds = occupied_bounds(
+        mask_array.shape,
+        lambda z0, z1: mask_array[z0:z1] != 0,
+        margin=closing_radius + 1,
+    )
+    if bounds is None:
+        return mask
+    (x0, y0, z0), (sx, sy, sz) = bounds
+    box = (slice(z0, z0 + sz), slice(y0, y0 + sy), slice(x0, x0 + sx))
+    mask_array[box] = refine_box(
+        mask_array[box] != 0, fill_holes, closing_radius, opening_radius
+    )
+    return mask
+
+
+def refined_components(mask):
+    # Label image of a refined 0/1 mask. Closing and hole filling add voxels
+    # no selected component had and can merge components, so statistics of
+    # the refined mask are taken over its own components
+    connected_components = planned_connected_components(mask)
+    labels = connected_components.GetOutput()
+    labels.DisconnectPipeline()
+    return labels
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Refine a binary or label mask")
+    parser.add_argument("mask")
+    parser.add_argument("out")
+    parser.add_argument("--fill-holes", action="store_true")
+    parser.add_argument("--closing", type=int, default=0, help="radius in voxels")
+    parser.add_argument("--opening", type=int, default=0, help="radius in voxels")
+    args = parser.parse_args()
+
+    refined = refine_mask(
+        itk.imread(args.mask), args.fill_holes, args.closing, args.opening
+    )
+    itk.imwrite(refined, args.out)
@@ -0,0 +1,169 @@
+import math
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import itk
+
+"""
+    Memory budget mode for the segmentation pipeline.
+    Stages are refused when their estimate does not fit in what is left of
+    the budget, and fail when their peak RSS went over it; the RSS / peak
+    RSS of every stage is recorded.
+"""
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+# ITK classes of the segmentation pipeline. ITK loads the wrapper module of a
+# class (and the modules it depends on) on first use, hundreds of MiB once per
+# process, which would otherwise be charged to whichever stage comes first
+PIPELINE_ITK_CLASSES = [
+    "MinimumMaximumImageCalculator",
+    "RescaleIntensityImageFilter",
+    "IntensityWindowingImageFilter",
+    "BinaryThresholdImageFilter",
+    "ThresholdImageFilter",
+    "ConnectedComponentImageFilter",
+    "CastImageFilter",
+    "LabelShapeKeepNObjectsImageFilter",
+    "NotImageFilter",
+    "BinaryFillholeImageFilter",
+    "SignedMaurerDistanceMapImageFilter",
+    "RegionOfInterestImageFilter",
+]
+# Bytes of one run of the run-length encoding of ConnectedComponentImageFilter
+# (index, length, label) and of one per-line run list
+RUN_BYTES = 48
+LINE_BYTES = 24
+
+
+class MemoryBudgetExceeded(MemoryError):
+    pass
+
+
+def current_rss():
+    # Resident set size of the process in bytes
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        return peak_rss()
+
+
+def peak_rss():
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if os.uname().sysname == "Darwin" else maxrss * 1024
+
+
+def _reset_peak_rss():
+    # Linux >= 4.0 lets a process reset its own high-water mark
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_since_reset():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return peak_rss()
+
+
+def estimate_image_bytes(image_type, size):
+    pixel_type = itk.template(image_type)[1][0]
+    return math.prod(size) * pixel_type.dtype.itemsize
+
+
+def estimate_connected_components_bytes(binary_image, label_bytes=2):
+    # The label image plus the run-length encoding of the foreground, which
+    # the filter keeps for the whole labelling
+    array = itk.array_view_from_image(binary_image) != 0
+    runs = np.count_nonzero(array[..., 0]) + np.count_nonzero(
+        array[..., 1:] & ~array[..., :-1]
+    )
+    lines = array.size // array.shape[-1]
+    return array.size * label_bytes + int(runs) * RUN_BYTES + lines * LINE_BYTES
+
+
+def load_itk_modules(names=PIPELINE_ITK_CLASSES):
+    for name in names:
+        getattr(itk, name)
+
+
+class MemoryBudget:
+    def __init__(self, limit_bytes=None):
+        self.limit_bytes = limit_bytes
+        self.records = []
+
+    def available(self):
+        if self.limit_bytes is None:
+            return math.inf
+        return self.limit_bytes - current_rss()
+
+    def check(self, name, estimated_bytes):
+        if estimated_bytes > self.available():
+            raise MemoryBudgetExceeded(
+                f"Stage '{name}' needs ~{estimated_bytes / 2**20:.1f} MiB but only "
+                f"{max(self.available(), 0) / 2**20:.1f} MiB of the "
+                f"{self.limit_bytes / 2**20:.1f} MiB budget is left"
+            )
+
+    @contextmanager
+    def stage(self, name, estimated_bytes=0):
+        self.check(name, estimated_bytes)
+        per_stage_peak = _reset_peak_rss()
+        rss_before = current_rss()
+        started = time.perf_counter()
+        yield
+        record = {
+            "stage": name,
+            "seconds": time.perf_counter() - started,
+            "rss_before": rss_before,
+            "rss_after": current_rss(),
+            "peak_rss": _peak_rss_since_reset() if per_stage_peak else peak_rss(),
+        }
+        self.records.append(record)
+        # The estimate is checked before the stage, the real peak after it
+        if self.limit_bytes is not None and record["peak_rss"] > self.limit_bytes:
+            raise MemoryBudgetExceeded(
+                f"Stage '{name}' peaked at {record['peak_rss'] / 2**20:.1f} MiB, "
+                f"over the {self.limit_bytes / 2**20:.1f} MiB budget"
+            )
+
+    def run(self, name, image_filter, estimated_bytes=0):
+        # Updates a filter within the budget and returns its output detached
+        # from the pipeline, so upstream buffers can be freed without the stage
+        # ever re-executing
+        with self.stage(name, estimated_bytes):
+            image_filter.Update()
+        output = image_filter.GetOutput()
+        output.DisconnectPipeline()
+        return output
+
+    def format_records(self):
+        lines = [f"{'stage':<32}{'s':>8}{'RSS MiB':>10}{'peak MiB':>10}"]
+        for row in self.records:
+            lines.append(
+                f"{row['stage']:<32}{row['seconds']:>8.3f}"
+                f"{row['rss_after'] / 2**20:>10.1f}{row['peak_rss'] / 2**20:>10.1f}"
+            )
+        return "\n".join(lines)
+
+
+def read_image(path, budget=None):
+    # Decode a volume once, after checking its header size against the budget
+    budget = MemoryBudget() if budget is None else budget
+    reader = itk.ImageFileReader.New(FileName=path)
+    reader.UpdateOutputInformation()
+    image = reader.GetOutput()
+    size = image.GetLargestPossibleRegion().GetSize()
+    return budget.run("read", reader, estimate_image_bytes(type(image), size))
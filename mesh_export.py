@@ -0,0 +1,140 @@
+import argparse
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import vtk
+from vtk.util import numpy_support
+
+"""
+    Tumor surface meshes from the binary mask.
+    Meshing (surface extraction, smoothing, decimation) runs on a background
+    thread so the render loop never waits for it, and meshes are cached by a
+    hash of the mask so an unchanged mask is never re-meshed.
+"""
+
+MESH_WRITERS = {
+    ".stl": vtk.vtkSTLWriter,
+    ".ply": vtk.vtkPLYWriter,
+    ".vtp": vtk.vtkXMLPolyDataWriter,
+}
+DEFAULT_TRIANGLE_BUDGET = 50000
+
+
+def mask_digest(mask, *params):
+    # Hash of the voxels, the grid and the meshing parameters
+    scalars = mask.GetPointData().GetScalars()
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(numpy_support.vtk_to_numpy(scalars).tobytes())
+    digest.update(
+        repr(
+            (mask.GetDimensions(), mask.GetSpacing(), mask.GetOrigin()) + params
+        ).encode()
+    )
+    return digest.hexdigest()
+
+
+def build_mesh(mask, target_triangles=DEFAULT_TRIANGLE_BUDGET, smoothing_iterations=15):
+    # Label 1 surface of the mask; vtkDiscreteFlyingEdges3D runs on vtkSMPTools
+    surface = vtk.vtkDiscreteFlyingEdges3D()
+    surface.SetInputData(mask)
+    surface.SetValue(0, 1)
+    surface.ComputeNormalsOff()
+    surface.ComputeGradientsOff()
+
+    smoother = vtk.vtkWindowedSincPolyDataFilter()
+    smoother.SetInputConnection(surface.GetOutputPort())
+    smoother.SetNumberOfIterations(smoothing_iterations)
+    smoother.SetPassBand(0.01)
+    smoother.BoundarySmoothingOff()
+    smoother.NonManifoldSmoothingOn()
+    smoother.NormalizeCoordinatesOn()
+    smoother.Update()
+    mesh = smoother.GetOutput()
+
+    triangles = mesh.GetNumberOfPolys()
+    if target_triangles and triangles > target_triangles:
+        decimate = vtk.vtkQuadricDecimation()
+        decimate.SetInputData(mesh)
+        decimate.SetTargetReduction(1.0 - target_triangles / triangles)
+        decimate.VolumePreservationOn()
+        decimate.Update()
+        mesh = decimate.GetOutput()
+
+    normals = vtk.vtkPolyDataNormals()
+    normals.SetInputData(mesh)
+    normals.SplittingOff()
+    normals.Update()
+    return normals.GetOutput()
+
+
+def write_mesh(mesh, path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in MESH_WRITERS:
+        raise ValueError(
+            f"path='{path}' has no mesh writer. Valid extensions are: "
+            f"{set(MESH_WRITERS)}"
+        )
+    writer = MESH_WRITERS[extension]()
+    writer.SetFileName(path)
+    writer.SetInputData(mesh)
+    if extension == ".stl":
+        writer.SetFileTypeToBinary()
+    writer.Write()
+
+
+class MeshExporter:
+    # Single background thread meshing snapshots of the mask; meshes are kept
+    # in an LRU cache keyed by mask_digest()
+    def __init__(self, target_triangles=DEFAULT_TRIANGLE_BUDGET, max_meshes=8):
+        self.target_triangles = target_triangles
+        self.max_meshes = max_meshes
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
+        self._meshes = OrderedDict()
+
+    def mesh(self, mask):
+        key = mask_digest(mask, self.target_triangles)
+        with self._lock:
+            if key in self._meshes:
+                self._meshes.move_to_end(key)
+                return self._meshes[key], True
+
+        mesh = build_mesh(mask, self.target_triangles)
+        with self._lock:
+            self._meshes[key] = mesh
+            while len(self._meshes) > self.max_meshes:
+                self._meshes.popitem(last=False)
+        return mesh, False
+
+    def _export(self, mask, path):
+        mesh, cached = self.mesh(mask)
+        write_mesh(mesh, path)
+        return path, mesh.GetNumberOfPolys(), cached
+
+    def submit(self, mask, path):
+        # The mask is copied on the caller's thread so later edits of the live
+        # mask cannot race with the worker
+        snapshot = vtk.vtkImageData()
+        snapshot.DeepCopy(mask)
+        return self._executor.submit(self._export, snapshot, path)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the tumor mask as a mesh")
+    parser.add_argument("mask", help="binary mask (MetaImage), e.g. output_mask.mha")
+    parser.add_argument("out", help="output mesh (.stl, .ply or .vtp)")
+    parser.add_argument("--triangles", type=int, default=DEFAULT_TRIANGLE_BUDGET)
+    args = parser.parse_args()
+
+    reader = vtk.vtkMetaImageReader()
+    reader.SetFileName(args.mask)
+    reader.Update()
+    mesh = build_mesh(reader.GetOutput(), args.triangles)
+    write_mesh(mesh, args.out)
+    print(f"{args.out}: {mesh.GetNumberOfPolys()} triangles")
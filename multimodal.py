@@ -0,0 +1,185 @@
+import argparse
+
+import numpy as np
+import vtk
+from vtk import vtkRenderer, vtkRenderWindow
+from vtk import vtkRenderWindowInteractor
+from vtk.util import numpy_support
+
+from sample import OnCustomClose, load_custom_volume
+
+"""
+    Multi-modality loading for BRATS cases (T1, T1C, T2, FLAIR on one grid).
+    The modalities are packed into a single multi-component vtkImageData so
+    they share one mapper / one texture upload; switching modality only
+    changes the per-component weights of the volume property.
+"""
+
+BRATS_MODALITIES = ("T1", "T1C", "T2", "FLAIR")
+MAX_COMPONENTS = 4
+# Candidates for the packed volume, narrowest first
+INTEGER_DTYPES = ("u1", "i1", "u2", "i2", "u4", "i4", "u8", "i8")
+
+
+def _header_image(reader):
+    info = reader.GetOutputInformation(0)
+    extent = info.Get(vtk.vtkStreamingDemandDrivenPipeline.WHOLE_EXTENT())
+    image = vtk.vtkImageData()
+    image.SetExtent(extent)
+    image.SetSpacing(info.Get(vtk.vtkDataObject.SPACING()))
+    image.SetOrigin(info.Get(vtk.vtkDataObject.ORIGIN()))
+    return image
+
+
+def _check_same_grid(images):
+    names = list(images)
+    reference = images[names[0]]
+    for name in names[1:]:
+        image = images[name]
+        for attr in ("GetDimensions", "GetSpacing", "GetOrigin"):
+            expected = getattr(reference, attr)()
+            found = getattr(image, attr)()
+            if not np.allclose(expected, found):
+                raise ValueError(
+                    f"{name} {attr[3:].lower()}={found} does not match "
+                    f"{names[0]} {attr[3:].lower()}={expected}"
+                )
+
+
+def _header_dtype(reader):
+    scalar_type = vtk.vtkImageData.GetScalarType(reader.GetOutputInformation(0))
+    return np.dtype(numpy_support.get_numpy_array_type(scalar_type))
+
+
+def narrowest_common_dtype(dtypes, low, high):
+    # Smallest dtype holding low..high, the value range of every modality
+    if any(np.issubdtype(dtype, np.floating) for dtype in dtypes):
+        return np.result_type(np.float32, *dtypes)
+    for dtype in INTEGER_DTYPES:
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return np.dtype(dtype)
+    return np.result_type(*dtypes)
+
+
+def load_multimodal_image(paths):
+    # paths: {modality name: MetaImage path}, in component order
+    if not 0 < len(paths) <= MAX_COMPONENTS:
+        raise ValueError(f"Expected 1 to {MAX_COMPONENTS} modalities, got {len(paths)}")
+
+    # Check the grids from the headers before decoding any voxel data
+    readers = {}
+    for name, path in paths.items():
+        reader = vtk.vtkMetaImageReader()
+        reader.SetFileName(path)
+        reader.UpdateInformation()
+        readers[name] = reader
+    headers = {name: _header_image(r) for name, r in readers.items()}
+    _check_same_grid(headers)
+    image = next(iter(headers.values()))
+    dtypes = [_header_dtype(reader) for reader in readers.values()]
+
+    # One modality is decoded at a time, copied into its component and
+    # released, so at most one decoded volume is alive next to the packed one
+    packed = np.empty(
+        (image.GetNumberOfPoints(), len(readers)), dtype=np.result_type(*dtypes)
+    )
+    low, high = np.inf, -np.inf
+    for i, reader in enumerate(readers.values()):
+        reader.Update()
+        scalars = reader.GetOutput().GetPointData().GetScalars()
+        array = numpy_support.vtk_to_numpy(scalars)
+        packed[:, i] = array
+        low, high = min(low, array.min()), max(high, array.max())
+        del array, scalars
+        reader.GetOutput().ReleaseData()
+    dtype = narrowest_common_dtype(dtypes, low, high)
+    if packed.dtype.itemsize == dtype.itemsize:
+        # Same width (e.g. int16 holding only non-negative values as uint16)
+        packed = packed.view(dtype)
+    elif packed.dtype != dtype:
+        packed = packed.astype(dtype)
+
+    vtk_array = numpy_support.numpy_to_vtk(packed, deep=False)
+    vtk_array.SetName("modalities")
+    image.GetPointData().SetScalars(vtk_array)
+    # numpy_to_vtk does not own the buffer
+    image._packed = packed
+    return image
+
+
+def set_modality_transfer_functions(volume_property, image, names):
+    # One color/opacity pair per component, using the same ramps as sample.py
+    scalars = image.GetPointData().GetScalars()
+    opacity_functions = []
+    for i, _ in enumerate(names):
+        _, data_max_val = scalars.GetRange(i)
+        seg_min_val, seg_max_val = 0, 0.6 * data_max_val
+
+        color_function = vtk.vtkColorTransferFunction()
+        color_function.AddRGBSegment(seg_min_val, *(0, 0, 0), seg_max_val, *(1, 1, 1))
+        opacity_function = vtk.vtkPiecewiseFunction()
+        opacity_function.AddSegment(seg_min_val, 0.0, seg_max_val, 0.1)
+
+        volume_property.SetColor(i, color_function)
+        volume_property.SetScalarOpacity(i, opacity_function)
+        opacity_functions.append(opacity_function)
+    return opacity_functions
+
+
+def show_modality(volume_property, names, active):
+    # Switching modality only touches shader weights, not the uploaded volume
+    for i, name in enumerate(names):
+        volume_property.SetComponentWeight(i, 1.0 if name == active else 0.0)
+
+
+def load_multimodal_volume(paths, render_with="gl", interpolation="linear"):
+    image = load_multimodal_image(paths)
+    producer = vtk.vtkTrivialProducer()
+    producer.SetOutput(image)
+
+    volume = load_custom_volume(
+        producer, render_with=render_with, interpolation=interpolation
+    )
+    names = list(paths)
+    set_modality_transfer_functions(volume.GetProperty(), image, names)
+    show_modality(volume.GetProperty(), names, names[0])
+    return volume, names
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Multi-modality volume viewer")
+    for name in BRATS_MODALITIES:
+        parser.add_argument(f"--{name.lower()}", metavar="PATH")
+    args = parser.parse_args()
+
+    paths = {
+        name: getattr(args, name.lower())
+        for name in BRATS_MODALITIES
+        if getattr(args, name.lower())
+    }
+    multimodal_volume, modality_names = load_multimodal_volume(paths)
+
+    multimodal_ren = vtkRenderer()
+    multimodal_ren.AddVolume(multimodal_volume)
+    multimodal_renWin = vtkRenderWindow()
+    multimodal_renWin.AddRenderer(multimodal_ren)
+    multimodal_iren = vtkRenderWindowInteractor()
+    multimodal_iren.SetRenderWindow(multimodal_renWin)
+    multimodal_iren.AddObserver("ExitEvent", OnCustomClose)
+
+    def OnModalityKey(interactor, event):
+        # Keys 1..4 select the modality to display
+        key = interactor.GetKeySym()
+        if key.isdigit() and 0 < int(key) <= len(modality_names):
+            active = modality_names[int(key) - 1]
+            show_modality(multimodal_volume.GetProperty(), modality_names, active)
+            multimodal_renWin.SetWindowName(active)
+            multimodal_renWin.Render()
+
+    multimodal_iren.AddObserver("KeyPressEvent", OnModalityKey)
+
+    multimodal_iren.Initialize()
+    multimodal_renWin.SetWindowName(modality_names[0])
+    multimodal_renWin.Render()
+    multimodal_iren.Start()
@@ -0,0 +1,324 @@
+import argparse
+import csv
+import itertools
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import itk
+
+from autocrop import crop_image, crop_offset
+from dtype_planner import compact_labels, planned_connected_components
+from execution_config import ExecutionConfig, available_cores
+from fused_threshold import filter_chain_binary, fusable, fused_threshold, raw_cutoff
+from memory_budget import read_image
+
+"""
+    Parameter sweep over the threshold level and the CUSTOM_FILTERS counts.
+    Work is shared across the grid: each threshold level is thresholded and
+    labelled once, and the shape attributes of all of its components come
+    from one shape label map. Every filter stack is then a ranking of those
+    attributes (LabelShapeKeepNObjects keeps the N largest / smallest,
+    stage after stage, and never changes a surviving component), and the
+    overlap with a reference mask is a sum of per-component overlap counts.
+    Threshold levels are spread over a pool of processes.
+"""
+
+SWEEP_FIELDS = [
+    "rank",
+    "threshold",
+    "counts",
+    "components",
+    "voxels",
+    "volume_mm3",
+    "largest_mm3",
+    "dice",
+]
+# Attributes the shape label map only computes on request
+PERIMETER_ATTRIBUTES = {
+    "Perimeter",
+    "PerimeterOnBorder",
+    "PerimeterOnBorderRatio",
+    "Roundness",
+}
+
+# Volume (and reference mask) of a pool process, loaded once by _load()
+_sweep = {}
+
+
+def parse_values(text):
+    # "90:130:4" -> [90, 94, ..., 130] (stop included), "3,5,8" -> [3, 5, 8]
+    if ":" in text:
+        start, stop, *step = (int(v) for v in text.split(":"))
+        return list(range(start, stop + 1, step[0] if step else 1))
+    return [int(v) for v in text.split(",") if v]
+
+
+def filter_stacks(filters, counts):
+    # Every combination of counts for the stages of filters; counts[i] is
+    # the list of NumberOfObjects values tried for stage i
+    return [
+        [(attribute, n, reverse) for (attribute, _, reverse), n in zip(filters, combo)]
+        for combo in itertools.product(*counts)
+    ]
+
+
+def label_level(image, intensity_range, level):
+    # Consecutive labels of the components at one threshold level, the same
+    # labelling the 3D chain of sample.py gives for Lower=level
+    if fusable(image):
+        binary = fused_threshold(image, raw_cutoff(intensity_range, level))
+    else:
+        binary = filter_chain_binary(image, intensity_range, level)
+    connected_components = planned_connected_components(binary)
+    labels = connected_components.GetOutput()
+    labels.DisconnectPipeline()
+    object_count = connected_components.GetObjectCount()
+    compact = compact_labels(labels, object_count)
+    if compact is not None:
+        compact.Update()
+        labels = compact.GetOutput()
+        labels.DisconnectPipeline()
+    return labels, object_count
+
+
+def shape_table(labels, attributes):
+    # {attribute: values} of the components of a label image, indexed by
+    # label - 1, from one shape label map
+    attributes = set(attributes) | {"NumberOfPixels"}
+    to_map = itk.LabelImageToShapeLabelMapFilter.New(
+        Input=labels,
+        BackgroundValue=0,
+        ComputePerimeter=bool(attributes & PERIMETER_ATTRIBUTES),
+        ComputeFeretDiameter="FeretDiameter" in attributes,
+        ComputeOrientedBoundingBox=any(
+            a.startswith("OrientedBoundingBox") for a in attributes
+        ),
+    )
+    to_map.Update()
+    label_map = to_map.GetOutput()
+    count = label_map.GetNumberOfLabelObjects()
+    table = {attribute: np.zeros(count) for attribute in attributes}
+    for i in range(count):
+        label_object = label_map.GetNthLabelObject(i)
+        index = label_object.GetLabel() - 1
+        for attribute in attributes:
+            table[attribute][index] = getattr(label_object, "Get" + attribute)()
+    return table
+
+
+def select_components(table, filters):
+    # Indices (label - 1) kept by the LabelShapeKeepNObjects stages of
+    # filters; ties go to the lower label
+    keep = np.arange(len(table["NumberOfPixels"]))
+    for attribute, number, reverse in filters:
+        values = table[attribute][keep]
+        order = np.argsort(values if reverse else -values, kind="stable")
+        keep = np.sort(keep[order[:number]])
+    return keep
+
+
+def _load(path, reference_path=None, threads=None):
+    # Pool initializer (also used in-process): the cropped volume, its
+    # intensity range and the reference mask on the cropped grid
+    ExecutionConfig(threads=threads).apply()
+    from sample import image_intensity_range
+
+    mri = read_image(path)
+    intensity_range = image_intensity_range(mri)
+    cropped = crop_image(mri)
+    spacing = np.array(cropped.GetSpacing())
+    _sweep.update(
+        image=cropped,
+        intensity_range=intensity_range,
+        voxel_volume=float(np.prod(spacing)),
+        reference=None,
+    )
+    if reference_path:
+        reference = itk.array_view_from_image(itk.imread(reference_path)) != 0
+        if reference.shape != itk.array_view_from_image(mri).shape:
+            raise ValueError(
+                f"reference shape={reference.shape} does not match "
+                f"mri shape={itk.array_view_from_image(mri).shape}"
+            )
+        x, y, z = crop_offset(cropped, mri)
+        sz, sy, sx = itk.array_view_from_image(cropped).shape
+        _sweep["reference"] = reference[z : z + sz, y : y + sy, x : x + sx]
+        # Reference voxels outside the crop count as missed
+        _sweep["reference_voxels"] = int(np.count_nonzero(reference))
+
+
+def sweep_level(level, stacks):
+    # One row per filter stack at one threshold level
+    labels, object_count = label_level(
+        _sweep["image"], _sweep["intensity_range"], level
+    )
+    attributes = {attribute for stack in stacks for attribute, _, _ in stack}
+    table = shape_table(labels, attributes)
+    overlap = None
+    if _sweep["reference"] is not None:
+        overlap = np.bincount(
+            itk.array_view_from_image(labels)[_sweep["reference"]].ravel(),
+            minlength=object_count + 1,
+        )[1:]
+
+    rows = []
+    for stack in stacks:
+        keep = select_components(table, stack)
+        sizes = table["NumberOfPixels"][keep]
+        row = {
+            "threshold": level,
+            "counts": "/".join(str(n) for _, n, _ in stack),
+            "components": len(keep),
+            "voxels": int(sizes.sum()),
+            "volume_mm3": float(sizes.sum()) * _sweep["voxel_volume"],
+            "largest_mm3": float(sizes.max(initial=0)) * _sweep["voxel_volume"],
+            "dice": None,
+        }
+        if overlap is not None:
+            total = row["voxels"] + _sweep["reference_voxels"]
+            row["dice"] = 2 * int(overlap[keep].sum()) / total if total else 1.0
+        rows.append(row)
+    return rows
+
+
+def run_sweep(path, thresholds, stacks, reference_path=None, jobs=None):
+    # Rows of every (threshold, filter stack) setting, in grid order
+    cores = len(available_cores())
+    jobs = min(jobs or cores, len(thresholds))
+    # The cores are split between the processes, one level per process at once
+    threads = max(cores // jobs, 1)
+    if jobs == 1:
+        _load(path, reference_path, threads)
+        levels = [sweep_level(level, stacks) for level in thresholds]
+    else:
+        with ProcessPoolExecutor(
+            jobs, initializer=_load, initargs=(path, reference_path, threads)
+        ) as pool:
+            levels = list(pool.map(sweep_level, thresholds, [stacks] * len(thresholds)))
+    return [row for rows in levels for row in rows]
+
+
+def rank_rows(rows, key):
+    # Best first (highest key); numbers the rows
+    ranked = sorted(rows, key=lambda row: -row[key])
+    for rank, row in enumerate(ranked, 1):
+        row["rank"] = rank
+    return ranked
+
+
+def verify_rows(path, rows, filters):
+    # Re-runs the LabelShapeKeepNObjects filters for rows and returns the
+    # rows whose component / voxel counts differ from the sweep
+    from sample import custom_morpho_filters
+
+    _load(path)
+    mismatches = []
+    for row in rows:
+        labels, _ = label_level(
+            _sweep["image"], _sweep["intensity_range"], row["threshold"]
+        )
+        counts = [int(n) for n in row["counts"].split("/")]
+        stack = [(a, n, r) for (a, _, r), n in zip(filters, counts)]
+        selection = custom_morpho_filters(labels, stack)
+        selection[-1].Update()
+        selected = itk.array_view_from_image(selection[-1].GetOutput())
+        voxels = int(np.count_nonzero(selected))
+        components = len(np.unique(selected[selected != 0]))
+        if (components, voxels) != (row["components"], row["voxels"]):
+            mismatches.append((row, components, voxels))
+    return mismatches
+
+
+def write_csv(rows, path):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=SWEEP_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    from sample import CUSTOM_FILTERS
+
+    parser = argparse.ArgumentParser(
+        description="Sweep the threshold and CUSTOM_FILTERS counts of sample.py"
+    )
+    parser.add_argument("path", help="MRI volume")
+    parser.add_argument(
+        "--thresholds",
+        type=parse_values,
+        default=[102],
+        metavar="LEVELS",
+        help="rescaled (0-255) levels, e.g. 90:130:4 or 96,102,108",
+    )
+    parser.add_argument(
+        "--counts",
+        type=parse_values,
+        nargs="+",
+        default=None,
+        metavar="COUNTS",
+        help="NumberOfObjects values per CUSTOM_FILTERS stage, e.g. 5:20:5 3,5 1:4",
+    )
+    parser.add_argument("--reference", help="reference mask for Dice scores")
+    parser.add_argument(
+        "--sort",
+        choices=["dice", "volume_mm3", "components", "largest_mm3"],
+        default=None,
+        help="ranking column (default: dice with a reference, else volume_mm3)",
+    )
+    parser.add_argument("--out", default="sweep.csv")
+    parser.add_argument("--jobs", type=int, default=None)
+    parser.add_argument("--top", type=int, default=10, help="rows to print")
+    parser.add_argument(
+        "--verify",
+        type=int,
+        default=0,
+        metavar="N",
+        help="re-run the ITK filters for the N best rows and compare",
+    )
+    args = parser.parse_args()
+
+    counts = args.counts or [[n] for _, n, _ in CUSTOM_FILTERS]
+    if len(counts) != len(CUSTOM_FILTERS):
+        parser.error(
+            f"--counts needs one value list per filter ({len(CUSTOM_FILTERS)})"
+        )
+    stacks = filter_stacks(CUSTOM_FILTERS, counts)
+    sort = args.sort or ("dice" if args.reference else "volume_mm3")
+    if sort == "dice" and not args.reference:
+        parser.error("--sort dice needs --reference")
+
+    started = time.perf_counter()
+    rows = rank_rows(
+        run_sweep(args.path, args.thresholds, stacks, args.reference, args.jobs), sort
+    )
+    seconds = time.perf_counter() - started
+    write_csv(rows, args.out)
+    print(
+        f"{len(rows)} settings ({len(args.thresholds)} thresholds x {len(stacks)} "
+        f"filter stacks) in {seconds:.1f} s, written to {args.out}"
+    )
+    print(
+        f"{'rank':>5}{'threshold':>10}{'counts':>12}{'components':>12}"
+        f"{'mm3':>12}{'largest mm3':>13}{'dice':>8}"
+    )
+    for row in rows[: args.top]:
+        dice = "" if row["dice"] is None else f"{row['dice']:.4f}"
+        print(
+            f"{row['rank']:>5}{row['threshold']:>10}{row['counts']:>12}"
+            f"{row['components']:>12}{row['volume_mm3']:>12.1f}"
+            f"{row['largest_mm3']:>13.1f}{dice:>8}"
+        )
+
+    if args.verify:
+        mismatches = verify_rows(args.path, rows[: args.verify], CUSTOM_FILTERS)
+        for row, components, voxels in mismatches:
+            print(
+                f"MISMATCH threshold={row['threshold']} counts={row['counts']}: "
+                f"filters give {components} components / {voxels} voxels, "
+                f"sweep {row['components']} / {row['voxels']}"
+            )
+        print(
+            f"Verified {min(args.verify, len(rows))} rows, {len(mismatches)} mismatched"
+        )
+        raise SystemExit(1 if mismatches else 0)
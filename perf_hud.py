@@ -0,0 +1,139 @@
+import statistics
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import vtk
+
+from memory_budget import current_rss
+
+"""
+    On-screen performance overlay for the render windows.
+    Frame times are kept in a fixed-size ring buffer fed by the renderer's
+    EndEvent, update latencies are split into the timed stages plus the first
+    frame after the update, and the text is rebuilt at most a few times per
+    second so the overlay costs next to nothing per frame. Updates computed
+    elsewhere (the segmentation worker) last until their result is rendered.
+"""
+
+HUD_SAMPLES = 120
+HUD_REFRESH_SECONDS = 0.25
+
+
+class PerfHud:
+    def __init__(self, renderer, samples=HUD_SAMPLES, visible=False):
+        self.renderer = renderer
+        self.frame_times = deque(maxlen=samples)
+        self.frame_stamps = deque(maxlen=samples)
+        self.stage_times = {}
+        self.last_update = None
+        self._update_started = None
+        self._waiting = False
+        self._last_refresh = 0.0
+        self._redraw_observer = None
+        self._redraw_timer = None
+
+        self.actor = vtk.vtkTextActor()
+        self.actor.GetPositionCoordinate().SetCoordinateSystemToNormalizedViewport()
+        self.actor.SetPosition(0.01, 0.99)
+        text_property = self.actor.GetTextProperty()
+        text_property.SetFontFamilyToCourier()
+        text_property.SetFontSize(13)
+        text_property.SetColor(0.2, 1.0, 0.2)
+        text_property.SetVerticalJustificationToTop()
+        self.actor.SetVisibility(visible)
+        renderer.AddViewProp(self.actor)
+        renderer.AddObserver("EndEvent", self._on_frame)
+
+    @property
+    def visible(self):
+        return bool(self.actor.GetVisibility())
+
+    def set_visible(self, visible):
+        self.actor.SetVisibility(visible)
+        self._last_refresh = 0.0
+
+    def toggle(self):
+        self.set_visible(not self.visible)
+
+    def mark_update(self, wait=False):
+        # Start of a user-triggered update (slider move, key press). With wait
+        # the frames before ready() do not end it
+        self._update_started = time.perf_counter()
+        self._waiting = wait
+        self.stage_times = {}
+
+    def ready(self):
+        # The awaited result is in; the next frame ends the update
+        self._waiting = False
+
+    def cancel_wait(self):
+        # The awaited result will not come
+        if self._waiting:
+            self._update_started = None
+            self._waiting = False
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        yield
+        self.stage_times[name] = time.perf_counter() - started
+
+    def _on_frame(self, renderer, event):
+        now = time.perf_counter()
+        frame_time = renderer.GetLastRenderTimeInSeconds()
+        updated = self._update_started is not None and not self._waiting
+        if updated:
+            # The first frame after an update also carries its texture upload;
+            # the excess over a typical frame is reported as the upload
+            typical = statistics.median(self.frame_times) if self.frame_times else 0.0
+            stages = dict(self.stage_times)
+            stages["upload"] = max(frame_time - typical, 0.0)
+            stages["render"] = frame_time - stages["upload"]
+            self.last_update = {"total": now - self._update_started, "stages": stages}
+            self._update_started = None
+        self.frame_times.append(frame_time)
+        self.frame_stamps.append(now)
+
+        if self.visible and (
+            updated or now - self._last_refresh >= HUD_REFRESH_SECONDS
+        ):
+            self._last_refresh = now
+            self.actor.SetInput(self.text())
+            if updated:
+                self._redraw_later()
+
+    def _redraw_later(self):
+        # Text set at the end of a frame only shows in the next one: one more
+        # frame is asked for, so a new latency does not wait for other input
+        window = self.renderer.GetRenderWindow()
+        interactor = window.GetInteractor() if window is not None else None
+        if interactor is None:
+            return
+        if self._redraw_observer is None:
+            self._redraw_observer = interactor.AddObserver("TimerEvent", self._on_timer)
+        self._redraw_timer = interactor.CreateOneShotTimer(1)
+
+    def _on_timer(self, interactor, event):
+        if self._redraw_timer is not None and (
+            interactor.GetTimerEventId() == self._redraw_timer
+        ):
+            self._redraw_timer = None
+            interactor.GetRenderWindow().Render()
+
+    def fps(self):
+        if len(self.frame_stamps) < 2:
+            return 0.0
+        elapsed = self.frame_stamps[-1] - self.frame_stamps[0]
+        return (len(self.frame_stamps) - 1) / elapsed if elapsed > 0 else 0.0
+
+    def text(self):
+        lines = [f"FPS {self.fps():6.1f}"]
+        if self.frame_times:
+            lines.append(f"frame {self.frame_times[-1] * 1000:7.1f} ms")
+        if self.last_update is not None:
+            lines.append(f"update {self.last_update['total'] * 1000:6.1f} ms")
+            for name, seconds in self.last_update["stages"].items():
+                lines.append(f"  {name:<12}{seconds * 1000:7.1f} ms")
+        lines.append(f"RSS {current_rss() / 2**20:8.1f} MiB")
+        return "\n".join(lines)
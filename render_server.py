@@ -0,0 +1,495 @@
+import argparse
+import itertools
+import json
+import queue
+import threading
+import time
+import urllib.request
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import vtk
+import itk
+from vtk.util import numpy_support
+
+from memory_budget import read_image
+from sample import (
+    CUSTOM_FILTERS,
+    MRI_FILE_PATH,
+    custom_morpho_filters,
+    generate_custom_mask,
+    load_custom_volume,
+    segment_mri_image,
+    set_custom_transfer_functions,
+)
+
+"""
+    Headless render service for the custom brain volume.
+    One offscreen render window serves every session; volumes and masks are
+    decoded/computed once per render node and shared between sessions.
+"""
+
+FRAME_FORMATS = {"jpeg", "png"}
+# The cpu mapper (vtkFixedPointVolumeRayCastMapper) cannot blend label masks
+RENDER_WITH = ["gl", "gpu"]
+DEFAULT_FRAME_SIZE = (512, 512)
+
+
+class SharedVolumeStore:
+    # Volumes (vtk source + ITK connected components + ITK image) and masks
+    # keyed by their inputs, shared by all sessions of the node.
+    def __init__(self, max_masks=32):
+        self.max_masks = max_masks
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._volumes = {}
+        self._masks = OrderedDict()
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def volume(self, path):
+        with self._key_lock(("volume", path)):
+            if path not in self._volumes:
+                # Decoded once: the rendered image is a VTK view of the ITK one,
+                # which is kept alive alongside it
+                mri = read_image(path)
+                source = vtk.vtkTrivialProducer()
+                source.SetOutput(itk.vtk_image_from_image(mri))
+                connected_components = segment_mri_image(mri)
+                self._volumes[path] = (source, connected_components, mri)
+            return self._volumes[path]
+
+    def mask(self, path, filters):
+        key = (path, tuple(filters))
+        with self._key_lock(("mask",) + key):
+            with self._lock:
+                if key in self._masks:
+                    self._masks.move_to_end(key)
+                    return self._masks[key]
+
+            _, connected_components, _ = self.volume(path)
+            cc_filters_result = custom_morpho_filters(
+                connected_components, filters=filters
+            )
+            result_image = generate_custom_mask(cc_filters_result[-1])
+            mask = itk.vtk_image_from_image(result_image.GetOutput())
+
+            with self._lock:
+                self._masks[key] = mask
+                while len(self._masks) > self.max_masks:
+                    self._masks.popitem(last=False)
+            return mask
+
+
+class RenderSession:
+    # Per-reviewer view state; everything heavy lives in the shared store
+    def __init__(self, path, size=DEFAULT_FRAME_SIZE, max_fps=15.0):
+        self.id = uuid.uuid4().hex
+        self.path = path
+        self.filters = list(CUSTOM_FILTERS)
+        self.opacity = 0.1
+        self.mask_opacity = 0.7
+        self.size = tuple(size)
+        self.max_fps = max_fps
+        self.quality = 85
+        self.camera = None
+        self.version = 0
+        self.frame = None
+        # (version, format) the cached frame was rendered for
+        self.frame_key = None
+        self.last_frame_time = 0.0
+        self.lock = threading.Lock()
+
+    def apply(self, command):
+        camera_ops = {}
+        with self.lock:
+            for key, value in command.items():
+                if key in ("azimuth", "elevation", "roll", "zoom", "dolly"):
+                    camera_ops[key] = float(value)
+                elif key == "reset_camera":
+                    camera_ops[key] = bool(value)
+                elif key == "opacity":
+                    self.opacity = float(value)
+                elif key == "mask_opacity":
+                    self.mask_opacity = float(value)
+                elif key == "filter":
+                    # Same semantics as cb_custom_morpho_filters(idx)(value)
+                    idx = int(value["index"])
+                    if not 0 <= idx < len(self.filters):
+                        raise IndexError(f"filter index {idx} out of range")
+                    attr, _, negate = self.filters[idx]
+                    self.filters[idx] = (attr, int(round(value["value"])), negate)
+                elif key == "size":
+                    self.size = (int(value[0]), int(value[1]))
+                elif key == "max_fps":
+                    self.max_fps = float(value)
+                elif key == "quality":
+                    self.quality = int(value)
+                else:
+                    raise ValueError(f"Unknown command '{key}'")
+            self.version += 1
+        return camera_ops
+
+
+class OffscreenRenderer:
+    # All VTK/OpenGL calls are made from this single thread
+    def __init__(self, store, render_with="gl"):
+        self.store = store
+        self.render_with = render_with
+        self._scenes = {}
+        self._jobs = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def call(self, fn, *args):
+        future = Future()
+        self._jobs.put((fn, args, future))
+        return future.result()
+
+    def _run(self):
+        self.ren = vtk.vtkRenderer()
+        self.renWin = vtk.vtkRenderWindow()
+        self.renWin.SetOffScreenRendering(1)
+        self.renWin.AddRenderer(self.ren)
+        while True:
+            fn, args, future = self._jobs.get()
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+    def _scene(self, path):
+        if path not in self._scenes:
+            source, _, _ = self.store.volume(path)
+            volume = load_custom_volume(source, render_with=self.render_with)
+            _, data_max_val = source.GetOutputDataObject(0).GetScalarRange()
+            seg_min_val, seg_max_val, opacity_function = set_custom_transfer_functions(
+                volume.GetProperty(), data_max_val
+            )
+            self._scenes[path] = (volume, seg_min_val, seg_max_val, opacity_function)
+        return self._scenes[path]
+
+    def _render(self, session, camera_ops, mask, fmt):
+        volume, seg_min_val, seg_max_val, opacity_function = self._scene(session.path)
+
+        self.ren.RemoveAllViewProps()
+        self.ren.AddVolume(volume)
+
+        if session.camera is None:
+            session.camera = vtk.vtkCamera()
+            camera_ops = dict(camera_ops, reset_camera=True)
+        self.ren.SetActiveCamera(session.camera)
+        if camera_ops.pop("reset_camera", False):
+            self.ren.ResetCamera()
+        for op, value in camera_ops.items():
+            getattr(session.camera, op.capitalize())(value)
+        self.ren.ResetCameraClippingRange()
+
+        opacity_function.RemoveAllPoints()
+        opacity_function.AddSegment(seg_min_val, 0.0, seg_max_val, session.opacity)
+        mapper = volume.GetMapper()
+        mapper.SetMaskBlendFactor(session.mask_opacity)
+        mapper.SetMaskInput(mask)
+
+        self.renWin.SetSize(*session.size)
+        self.renWin.Render()
+        return encode_frame(self.renWin, fmt, session.quality)
+
+    def render(self, session, camera_ops=None, fmt="jpeg"):
+        _check_frame_format(fmt)
+        with session.lock:
+            filters = list(session.filters)
+        # Masks are computed (or fetched) outside of the render thread
+        mask = self.store.mask(session.path, filters)
+        return self.call(self._render, session, dict(camera_ops or {}), mask, fmt)
+
+    def close(self):
+        self.call(self.renWin.Finalize)
+
+
+def _check_frame_format(fmt):
+    if fmt not in FRAME_FORMATS:
+        raise ValueError(
+            f"format='{fmt}' is not a valid arg. Valid values are: {FRAME_FORMATS}"
+        )
+
+
+def encode_frame(render_window, fmt="jpeg", quality=85):
+    window_to_image = vtk.vtkWindowToImageFilter()
+    window_to_image.SetInput(render_window)
+    window_to_image.ReadFrontBufferOff()
+    window_to_image.Update()
+
+    if fmt == "jpeg":
+        writer = vtk.vtkJPEGWriter()
+        writer.SetQuality(quality)
+    else:
+        writer = vtk.vtkPNGWriter()
+    writer.SetWriteToMemory(1)
+    writer.SetInputConnection(window_to_image.GetOutputPort())
+    writer.Write()
+    return numpy_support.vtk_to_numpy(writer.GetResult()).tobytes()
+
+
+class RenderService:
+    def __init__(self, default_path=MRI_FILE_PATH, render_with="gl"):
+        self.default_path = default_path
+        self.store = SharedVolumeStore()
+        self.renderer = OffscreenRenderer(self.store, render_with=render_with)
+        self.sessions = {}
+        self._pending_camera = {}
+        self._lock = threading.Lock()
+
+    def create_session(self, path=None, **kwargs):
+        session = RenderSession(path or self.default_path, **kwargs)
+        # Warm the shared store before the first frame is requested
+        self.store.volume(session.path)
+        with self._lock:
+            self.sessions[session.id] = session
+            self._pending_camera[session.id] = {}
+        return session
+
+    def close_session(self, session_id):
+        with self._lock:
+            self.sessions.pop(session_id, None)
+            self._pending_camera.pop(session_id, None)
+
+    def command(self, session_id, command):
+        session = self.sessions[session_id]
+        camera_ops = session.apply(command)
+        with self._lock:
+            pending = self._pending_camera[session_id]
+            for op, value in camera_ops.items():
+                if op == "zoom":
+                    pending[op] = pending.get(op, 1.0) * value
+                elif op == "reset_camera":
+                    pending.clear()
+                    pending[op] = value
+                else:
+                    pending[op] = pending.get(op, 0.0) + value
+        return session.version
+
+    def frame(self, session_id, fmt="jpeg"):
+        # Returns the newest frame, re-rendering only when the session or the
+        # requested format changed
+        session = self.sessions[session_id]
+        with self._lock:
+            camera_ops = self._pending_camera[session_id]
+            self._pending_camera[session_id] = {}
+        key = (session.version, fmt)
+        if session.frame is None or session.frame_key != key or camera_ops:
+            session.frame = self.renderer.render(session, camera_ops, fmt)
+            session.frame_key = key
+        session.last_frame_time = time.monotonic()
+        return session.frame
+
+    def stream(self, session_id, fmt="jpeg"):
+        # Yields frames no faster than the session's max_fps, skipping
+        # intervals in which nothing changed
+        session = self.sessions[session_id]
+        sent_version = None
+        while session_id in self.sessions:
+            started = time.monotonic()
+            with self._lock:
+                has_camera_ops = bool(self._pending_camera.get(session_id))
+            if sent_version != session.version or has_camera_ops:
+                sent_version = session.version
+                yield self.frame(session_id, fmt)
+            interval = 1.0 / max(session.max_fps, 0.1)
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+
+def make_handler(service):
+    class RenderRequestHandler(BaseHTTPRequestHandler):
+        def _send(self, status, body, content_type="application/json"):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_json(self, status, obj):
+            self._send(status, json.dumps(obj).encode())
+
+        def _read_json(self):
+            length = int(self.headers.get("Content-Length", 0))
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def _route(self):
+            url = urlparse(self.path)
+            parts = [p for p in url.path.split("/") if p]
+            query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            return parts, query
+
+        def do_POST(self):
+            parts, _ = self._route()
+            try:
+                if parts == ["sessions"]:
+                    params = self._read_json()
+                    session = service.create_session(**params)
+                    self._send_json(200, {"session": session.id})
+                elif len(parts) == 3 and parts[0] == "sessions":
+                    if parts[2] != "commands":
+                        raise KeyError(parts[2])
+                    version = service.command(parts[1], self._read_json())
+                    self._send_json(200, {"version": version})
+                else:
+                    self._send_json(404, {"error": "not found"})
+            except KeyError as e:
+                self._send_json(404, {"error": f"unknown {e}"})
+            except (ValueError, TypeError, IndexError) as e:
+                self._send_json(400, {"error": str(e)})
+            except Exception as e:
+                self._send_json(500, {"error": f"{type(e).__name__}: {e}"})
+
+        def do_DELETE(self):
+            parts, _ = self._route()
+            if len(parts) == 2 and parts[0] == "sessions":
+                service.close_session(parts[1])
+                self._send_json(200, {})
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def do_GET(self):
+            parts, query = self._route()
+            fmt = query.get("format", "jpeg")
+            if len(parts) != 3 or parts[0] != "sessions":
+                self._send_json(404, {"error": "not found"})
+                return
+            try:
+                _check_frame_format(fmt)
+                if parts[2] == "frame":
+                    self._send(200, service.frame(parts[1], fmt), f"image/{fmt}")
+                elif parts[2] == "stream":
+                    self._stream(parts[1], fmt)
+                else:
+                    self._send_json(404, {"error": "not found"})
+            except KeyError as e:
+                self._send_json(404, {"error": f"unknown {e}"})
+            except ValueError as e:
+                self._send_json(400, {"error": str(e)})
+            except Exception as e:
+                # e.g. a VTK RuntimeError from the render thread
+                self._send_json(500, {"error": f"{type(e).__name__}: {e}"})
+
+        def _stream(self, session_id, fmt):
+            # multipart/x-mixed-replace stream, displayable by any browser.
+            # The first frame is rendered before the headers go out, so a
+            # failing render is still answered with an error status
+            frames = service.stream(session_id, fmt)
+            first = next(frames)
+            self.send_response(200)
+            self.send_header(
+                "Content-Type", "multipart/x-mixed-replace; boundary=frame"
+            )
+            self.end_headers()
+            try:
+                for frame in itertools.chain([first], frames):
+                    self.wfile.write(b"--frame\r\n")
+                    self.wfile.write(f"Content-Type: image/{fmt}\r\n".encode())
+                    self.wfile.write(f"Content-Length: {len(frame)}\r\n\r\n".encode())
+                    self.wfile.write(frame + b"\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            except Exception:
+                # Too late for a status: the stream ends with the connection
+                self.close_connection = True
+
+        def log_message(self, format, *args):
+            pass
+
+    return RenderRequestHandler
+
+
+def serve(host="127.0.0.1", port=8765, path=MRI_FILE_PATH, render_with="gl"):
+    service = RenderService(default_path=path, render_with=render_with)
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    server.daemon_threads = True
+    return server, service
+
+
+class RenderClient:
+    # Minimal stand-in client speaking the same HTTP protocol as a viewer
+    def __init__(self, url="http://127.0.0.1:8765"):
+        self.url = url.rstrip("/")
+        self.session = None
+
+    def _request(self, method, path, body=None):
+        data = None if body is None else json.dumps(body).encode()
+        request = urllib.request.Request(self.url + path, data=data, method=method)
+        request.add_header("Content-Type", "application/json")
+        with urllib.request.urlopen(request) as response:
+            return response.read()
+
+    def open(self, **params):
+        reply = json.loads(self._request("POST", "/sessions", params))
+        self.session = reply["session"]
+        return self.session
+
+    def command(self, **command):
+        path = f"/sessions/{self.session}/commands"
+        return json.loads(self._request("POST", path, command))["version"]
+
+    def frame(self, fmt="jpeg"):
+        return self._request("GET", f"/sessions/{self.session}/frame?format={fmt}")
+
+    def close(self):
+        self._request("DELETE", f"/sessions/{self.session}")
+        self.session = None
+
+
+def run_stand_in_client(url, out_prefix=None):
+    # Drives a session through the same steps a reviewer would take in sample.py
+    client = RenderClient(url)
+    client.open()
+    steps = [
+        {},
+        {"azimuth": 30},
+        {"opacity": 0.3},
+        {"mask_opacity": 0.9},
+        {"filter": {"index": 2, "value": 1}},
+        {"elevation": 15, "zoom": 1.2},
+    ]
+    for i, step in enumerate(steps):
+        started = time.perf_counter()
+        if step:
+            client.command(**step)
+        frame = client.frame()
+        elapsed = (time.perf_counter() - started) * 1000
+        print(f"step {i} {json.dumps(step)}: {len(frame)} bytes in {elapsed:.1f} ms")
+        if out_prefix:
+            with open(f"{out_prefix}_{i}.jpeg", "wb") as f:
+                f.write(frame)
+    client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offscreen brain volume renderer")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--path", default=MRI_FILE_PATH)
+    parser.add_argument("--render-with", default="gl", choices=RENDER_WITH)
+    parser.add_argument(
+        "--stand-in-client",
+        action="store_true",
+        help="start the server, drive it with a local client and exit",
+    )
+    parser.add_argument("--out-prefix", default=None)
+    args = parser.parse_args()
+
+    server, service = serve(args.host, args.port, args.path, args.render_with)
+    if args.stand_in_client:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        run_stand_in_client(
+            f"http://{args.host}:{server.server_address[1]}", args.out_prefix
+        )
+        server.shutdown()
+        service.renderer.close()
+    else:
+        print(f"Serving on http://{args.host}:{server.server_address[1]}")
+        server.serve_forever()
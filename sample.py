@@ -1,16 +1,70 @@
+import argparse
+import math
+import sys
+
 import vtk
 import itk
 from vtk import vtkRenderer, vtkRenderWindow
 from vtk import vtkRenderWindowInteractor
-from vtk import vtkMetaImageReader
+
+from autocrop import crop_image, crop_offset, image_geometry, uncrop_image
+from dtype_planner import (
+    binary_mask,
+    compact_labels,
+    planned_connected_components,
+    planned_rescale,
+    planned_threshold,
+    record_stage,
+)
+from execution_config import (
+    ExecutionConfig,
+    configure_stage,
+    parse_cores,
+    parse_stage_threads,
+)
+from fused_threshold import fusable, fused_threshold, raw_cutoff
+from interaction_replay import (
+    Recorder,
+    add_replay_arguments,
+    finish_replay,
+    latency_report,
+    read_events,
+    replay,
+)
+from mask_buffer import MaskBuffer
+from mask_refine import REFINE, refine_mask, refined_components
+from memory_budget import (
+    MemoryBudget,
+    estimate_connected_components_bytes,
+    load_itk_modules,
+    read_image,
+)
+from mesh_export import MeshExporter
+from perf_hud import PerfHud
+from segmentation_worker import WORKER_POLL_MS, SegmentationWorker
+from slice_segmentation import SliceSegmentation, stack_axis
+from tumor_stats import component_statistics, write_csv
 
 MRI_FILE_PATH = "/Users/sachin_veera/Desktop/brain-tumor-segmentation-master-2/data/BRATS_HG0015_T1C.mha"
 MASK_OUTPUT_PATH = (
     "/Users/sachin_veera/Desktop/brain-tumor-segmentation-master-2/temp/output_mask.mha"
 )
+MESH_OUTPUT_PATH = (
+    "/Users/sachin_veera/Desktop/brain-tumor-segmentation-master-2/temp/tumor_mesh.stl"
+)
+STATS_OUTPUT_PATH = (
+    "/Users/sachin_veera/Desktop/brain-tumor-segmentation-master-2/temp/tumor_stats.csv"
+)
+
+# Define connected components filters
+CUSTOM_FILTERS = [
+    ("NumberOfPixels", 10, False),
+    ("Flatness", 5, True),
+    ("NumberOfPixels", 3, False),
+]
 
 
-def custom_morpho_filters(image, filters):
+def custom_morpho_filters(image, filters, release_data=False):
     history = [image]
     for attribute, number, reverse in filters:
         history.append(
@@ -22,56 +76,85 @@ def custom_morpho_filters(image, filters):
                 ReverseOrdering=reverse,
             )
         )
+        configure_stage("keep_objects", history[-1])
+    if release_data:
+        # Intermediate stages free their output once the next stage has run
+        for stage in history[1:-1]:
+            stage.ReleaseDataFlagOn()
     return history
 
 
-def generate_custom_mask(image, path_out=None):
-    mask = itk.NotImageFilter(Input=image)
-    mask = itk.NotImageFilter(Input=mask)
-
-    converted = itk.CastImageFilter[itk.Image[itk.SS, 3], itk.Image[itk.UC, 3]].New(
-        Input=mask
-    )
-
-    result_image = itk.RescaleIntensityImageFilter.New(
-        Input=converted,
-        OutputMinimum=0,
-        OutputMaximum=1,
-    )
+def generate_custom_mask(image, path_out=None, reference=None):
+    # Labels > 0 become 1 in a uchar mask, without intermediate copies.
+    # A mask computed on a cropped volume is written on the reference grid.
+    result_image = binary_mask(image)
+    result_image.Update()
 
-    if path_out:
+    if path_out and reference is not None:
+        itk.imwrite(uncrop_image(result_image.GetOutput(), reference), path_out)
+    elif path_out:
         writer = itk.ImageFileWriter.New(Input=result_image, FileName=path_out)
         writer.Update()
-    else:
-        result_image.Update()
 
     return result_image
 
 
-mri_reader = itk.ImageFileReader(FileName=MRI_FILE_PATH)
+def image_intensity_range(image):
+    calculator = itk.MinimumMaximumImageCalculator[type(image)].New()
+    calculator.SetImage(image)
+    calculator.SetRegion(image.GetLargestPossibleRegion())
+    calculator.Compute()
+    return calculator.GetMinimum(), calculator.GetMaximum()
+
+
+def segment_mri_image(mri_reader, report=None, budget=None, intensity_range=None):
+    # Threshold the rescaled MRI and label its connected components, using
+    # the narrowest pixel type for every stage and releasing each stage's
+    # input once it has been consumed
+    budget = MemoryBudget() if budget is None else budget
+    voxels = math.prod(itk.size(mri_reader))
+
+    # The range of the whole volume keeps the rescale exact when mri_reader
+    # is a crop of it
+    if intensity_range is None:
+        intensity_range = image_intensity_range(mri_reader)
+    if fusable(mri_reader):
+        # One pass over the raw voxels instead of rescale + threshold
+        cutoff = raw_cutoff(intensity_range, lower=102)
+        with budget.stage("fused_threshold", voxels * 1):
+            binary_image = fused_threshold(mri_reader, cutoff)
+        record_stage(report, "fused_threshold", binary_image)
+    else:
+        rescaled_mri = planned_rescale(mri_reader, 0, 255, intensity_range)
+        binary_image = planned_threshold(rescaled_mri, lower=102)
+        binary_image = budget.run("rescale+threshold", binary_image, voxels * 1)
+        record_stage(report, "rescale+threshold", binary_image)
 
-rescaled_mri = itk.RescaleIntensityImageFilter.New(
-    Input=mri_reader, OutputMinimum=0, OutputMaximum=255
-)
+    estimated_bytes = 0
+    if budget.limit_bytes is not None:
+        estimated_bytes = estimate_connected_components_bytes(binary_image)
+    with budget.stage("connected_components", estimated_bytes):
+        connected_components = planned_connected_components(binary_image)
+    record_stage(report, "connected_components", connected_components.GetOutput())
 
-binary_image = itk.ThresholdImageFilter.New(
-    Input=rescaled_mri,
-    Lower=102,
-)
+    # Detach the labels from the pipeline so the thresholded volume can be
+    # freed without the labelling ever being re-executed
+    labels = connected_components.GetOutput()
+    labels.DisconnectPipeline()
+    binary_image.ReleaseData()
 
-connected_components = itk.ConnectedComponentImageFilter.New(
-    Input=binary_image,
-)
+    compact = compact_labels(labels, connected_components.GetObjectCount())
+    if compact is not None:
+        labels = budget.run("compact_labels", compact, voxels * 1)
+        record_stage(report, "compact_labels", labels)
 
-# Define and apply connected components filters
-CUSTOM_FILTERS = [
-    ("NumberOfPixels", 10, False),
-    ("Flatness", 5, True),
-    ("NumberOfPixels", 3, False),
-]
+    return labels
 
-cc_filters_result = custom_morpho_filters(connected_components, filters=CUSTOM_FILTERS)
-custom_mask = generate_custom_mask(cc_filters_result[-1], path_out=MASK_OUTPUT_PATH)
+
+def segment_connected_components(path, report=None, budget=None):
+    mri_reader = read_image(path, budget)
+    record_stage(report, "read", mri_reader)
+    return segment_mri_image(mri_reader, report, budget)
 
 
 # VTK Rendering
@@ -99,6 +182,7 @@ def load_custom_volume(
     else:
         raise ValueError("Unexpected value for render_with")
 
+    configure_stage("render", mapper)
     mapper.SetInputConnection(reader.GetOutputPort())
     mapper.SetAutoAdjustSampleDistances(0)
     mapper.SetSampleDistance(0.5)
@@ -124,42 +208,31 @@ def load_custom_volume(
     return volume_object
 
 
-# Load volumes and generated custom mask
-reader_mri = vtk.vtkMetaImageReader()
-reader_mri.SetFileName(MRI_FILE_PATH)
-reader_mask = vtk.vtkMetaImageReader()
-reader_mask.SetFileName(MASK_OUTPUT_PATH)
-reader_mask.Update()
-
-custom_volume = load_custom_volume(reader_mri)
-custom_volume_property = custom_volume.GetProperty()
-custom_volume_mapper = custom_volume.GetMapper()
-
-# Set rendering properties (color, opacity)
-data_min_val, data_max_val = reader_mri.GetOutput().GetScalarRange()
-
-seg_min_val, seg_max_val = 0, 0.6 * data_max_val
-custom_color_function = vtk.vtkColorTransferFunction()
-custom_color_function.AddRGBSegment(seg_min_val, *(0, 0, 0), seg_max_val, *(1, 1, 1))
+def set_custom_transfer_functions(volume_property, data_max_val):
+    # Set rendering properties (color, opacity)
+    seg_min_val, seg_max_val = 0, 0.6 * data_max_val
+    custom_color_function = vtk.vtkColorTransferFunction()
+    custom_color_function.AddRGBSegment(
+        seg_min_val, *(0, 0, 0), seg_max_val, *(1, 1, 1)
+    )
 
-custom_color_mask_function = vtk.vtkColorTransferFunction()
-custom_color_mask_function.AddRGBSegment(
-    seg_min_val, *(0, 0, 0), seg_max_val, *(1, 0, 0)
-)
+    custom_color_mask_function = vtk.vtkColorTransferFunction()
+    custom_color_mask_function.AddRGBSegment(
+        seg_min_val, *(0, 0, 0), seg_max_val, *(1, 0, 0)
+    )
 
-custom_opacity_function = vtk.vtkPiecewiseFunction()
-custom_opacity_function.AddSegment(seg_min_val, 0.0, seg_max_val, 0.1)
+    custom_opacity_function = vtk.vtkPiecewiseFunction()
+    custom_opacity_function.AddSegment(seg_min_val, 0.0, seg_max_val, 0.1)
 
-custom_opacity_mask_function = vtk.vtkPiecewiseFunction()
-custom_opacity_mask_function.AddSegment(seg_min_val, 0.0, seg_max_val, 1.0)
+    custom_opacity_mask_function = vtk.vtkPiecewiseFunction()
+    custom_opacity_mask_function.AddSegment(seg_min_val, 0.0, seg_max_val, 1.0)
 
-custom_volume_property.SetColor(custom_color_function)
-custom_volume_property.SetScalarOpacity(custom_opacity_function)
-custom_volume_property.SetLabelColor(1, custom_color_mask_function)
-custom_volume_property.SetLabelScalarOpacity(1, custom_opacity_mask_function)
+    volume_property.SetColor(custom_color_function)
+    volume_property.SetScalarOpacity(custom_opacity_function)
+    volume_property.SetLabelColor(1, custom_color_mask_function)
+    volume_property.SetLabelScalarOpacity(1, custom_opacity_mask_function)
 
-# Apply generated custom mask
-custom_volume_mapper.SetMaskInput(reader_mask.GetOutput())
+    return seg_min_val, seg_max_val, custom_opacity_function
 
 
 # Define UI callbacks
@@ -182,22 +255,135 @@ def cb_opacity_mask_custom(x):
 def cb_custom_morpho_filters(idx):
     # Generate callbacks to update the custom morpho filters
     def cb(x):
+        global cc_filters_result
         attr, _, negate = CUSTOM_FILTERS[idx]
         CUSTOM_FILTERS[idx] = (attr, x, negate)
 
-        cc_filters_result = custom_morpho_filters(
-            connected_components, filters=CUSTOM_FILTERS
-        )
+        perf_hud.mark_update(wait=segmentation is not None)
+        if segmentation is None and slice_segmentation is None:
+            with perf_hud.stage("mask"):
+                cc_filters_result = custom_morpho_filters(
+                    connected_components, filters=CUSTOM_FILTERS, release_data=True
+                )
+                cc_filters_result[-1].Update()
 
-        result_image = generate_custom_mask(cc_filters_result[-1], MASK_OUTPUT_PATH)
-        reader_mask = vtkMetaImageReader()
-        reader_mask.SetFileName(MASK_OUTPUT_PATH)
-        reader_mask.Update()
-        custom_volume_mapper.SetMaskInput(reader_mask.GetOutput())
+        update_custom_mask()
 
     return cb
 
 
+def cb_custom_refine(x):
+    # Closing, hole filling and opening with radius x; 0 turns refinement off.
+    # Radii are whole voxels whatever value the slider reports
+    radius = round(x)
+    refine = {
+        "fill_holes": radius > 0,
+        "closing_radius": radius,
+        "opening_radius": radius,
+    }
+    if refine == REFINE:
+        # Dragging within one integer step
+        return
+    REFINE.update(refine)
+    perf_hud.mark_update(wait=segmentation is not None)
+    update_custom_mask()
+
+
+def update_custom_mask():
+    # Refines the selected components; only the box of voxels that changed
+    # is written into the mapper's mask
+    if segmentation is not None:
+        # Computed by the worker, on_segmentation_timer swaps the mask in
+        segmentation.request(CUSTOM_FILTERS, REFINE)
+        return
+    if slice_segmentation is not None:
+        # Every slice of the stack goes through the whole chain again
+        with perf_hud.stage("slices"):
+            mask = slice_segmentation.segment(CUSTOM_FILTERS, REFINE)
+    else:
+        with perf_hud.stage("refine"):
+            mask = refine_mask(cc_filters_result[-1].GetOutput(), **REFINE)
+    with perf_hud.stage("mask buffer"):
+        mask_buffer.update(mask)
+
+
+def on_segmentation_timer(interactor, event):
+    # Polls the segmentation worker without ever waiting for it
+    mask = segmentation.poll()
+    for message in segmentation.messages:
+        _report_worker_message(message)
+    segmentation.messages.clear()
+    latest = segmentation.received >= segmentation.requested
+    if mask is not None:
+        # The update started at the slider move ends with the frame showing
+        # the mask of the latest request
+        perf_hud.stage_times["worker"] = segmentation.last_seconds
+        if latest:
+            perf_hud.ready()
+        custom_volume_mapper.SetMaskInput(mask)
+        interactor.GetRenderWindow().Render()
+    elif latest:
+        # The latest request failed or was dropped
+        perf_hud.cancel_wait()
+
+
+def _report_worker_message(message):
+    if message[0] == "stats":
+        _print_stats(message[2])
+    elif message[0] == "written":
+        print(f"Mask written to {message[1]}")
+    else:
+        print(f"Segmentation worker: {message[1]}")
+
+
+def _print_stats(components):
+    for row in components:
+        print(
+            f"label {row['label']}: {row['volume_mm3']:.1f} mm3 "
+            f"({100 * row['brain_fraction']:.2f}% of brain), "
+            f"mean intensity {row['mean_intensity']:.1f}"
+        )
+
+
+def _report_mesh(future):
+    path, triangles, cached = future.result()
+    print(f"Mesh written to {path}: {triangles} triangles{' (cached)' * cached}")
+
+
+def OnCustomKeyPress(interactor, event):
+    # Reports only run on demand, never in the slider loop:
+    # 's' writes the component statistics, 'm' meshes the mask in the background,
+    # 'w' writes the mask, 'h' toggles the performance HUD
+    key = interactor.GetKeySym()
+    if key == "s" and segmentation is not None:
+        segmentation.send("stats", STATS_OUTPUT_PATH)
+    elif key == "s":
+        if slice_segmentation is not None:
+            # A slice stack has one mask, reported as a single component
+            labels = slice_segmentation.mask
+        elif any(REFINE.values()):
+            # The components of the refined mask, the one 'w' and 'm' export
+            labels = refined_components(mask_buffer.itk_image)
+        else:
+            labels = cc_filters_result[-1].GetOutput()
+        stats = component_statistics(
+            labels, mri_image, index_offset=crop_offset(mri_image, mri_geometry)
+        )
+        write_csv(stats, STATS_OUTPUT_PATH)
+        _print_stats(stats["components"])
+    elif key == "m":
+        mask = custom_volume_mapper.GetMaskInput()
+        mesh_exporter.submit(mask, MESH_OUTPUT_PATH).add_done_callback(_report_mesh)
+    elif key == "w" and segmentation is not None:
+        segmentation.send("write_mask", MASK_OUTPUT_PATH)
+    elif key == "w":
+        mask_buffer.write(MASK_OUTPUT_PATH, reference=mri_geometry)
+        print(f"Mask written to {MASK_OUTPUT_PATH}")
+    elif key == "h":
+        perf_hud.toggle()
+        interactor.GetRenderWindow().Render()
+
+
 def AddCustomSlider(
     interactor,
     value_range,
@@ -218,10 +404,6 @@ def AddCustomSlider(
             value = round(value)
             slider_representation.SetValue(value)
         callback(value)
-        sliderWidget.AddObserver(
-            "InteractionEvent",
-            lambda s, *args: callback(s.GetSliderRepresentation().GetValue()),
-        )
 
     # Set slider properties
     slider = vtk.vtkSliderRepresentation2D()
@@ -254,69 +436,296 @@ def AddCustomSlider(
     return sliderWidget
 
 
-custom_ren = vtkRenderer()
-custom_ren.AddVolume(custom_volume)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Brain tumor volume rendering")
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        default=None,
+        metavar="MiB",
+        help="refuse stages that would exceed this process RSS, fail those that did",
+    )
+    parser.add_argument(
+        "--crop-margin",
+        type=int,
+        default=0,
+        metavar="VOXELS",
+        help="margin kept around the non-background bounding box",
+    )
+    parser.add_argument(
+        "--no-crop", action="store_true", help="process and render the full grid"
+    )
+    parser.add_argument(
+        "--threads", type=int, default=None, help="threads for ITK and VTK"
+    )
+    parser.add_argument(
+        "--stage-threads",
+        type=parse_stage_threads,
+        default={},
+        metavar="STAGE=N,...",
+        help="per-stage thread counts, e.g. connected_components=2",
+    )
+    parser.add_argument(
+        "--pin-cores",
+        type=parse_cores,
+        default=None,
+        metavar="CORES",
+        help="pin the process to these cores, e.g. 0-3",
+    )
+    parser.add_argument(
+        "--hud", action="store_true", help="show the performance overlay ('h')"
+    )
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="segment in a separate process, sharing the volume and masks",
+    )
+    parser.add_argument(
+        "--slices",
+        choices=["auto", "2d", "3d"],
+        default="auto",
+        help="segment each 2D slice on its own (auto: when one axis is very thin)",
+    )
+    parser.add_argument("--record", metavar="PATH", help="record interactions")
+    parser.add_argument(
+        "--replay", metavar="PATH", help="replay a recording offscreen and report"
+    )
+    add_replay_arguments(parser)
+    args = parser.parse_args()
 
-custom_renWin = vtkRenderWindow()
-custom_renWin.AddRenderer(custom_ren)
+    execution_config = ExecutionConfig(
+        args.threads, args.stage_threads, args.pin_cores
+    ).apply()
+    print(f"Execution: {execution_config.describe()}")
 
-custom_iren = vtkRenderWindowInteractor()
-custom_iren.SetRenderWindow(custom_renWin)
+    memory_budget = MemoryBudget(
+        None if args.memory_budget is None else int(args.memory_budget * 2**20)
+    )
 
-custom_iren.AddObserver("ExitEvent", OnCustomClose)
+    segmentation = slice_segmentation = None
+    if args.worker:
+        # The worker decodes and segments the volume; the volume and masks are
+        # shared memory that VTK maps in place
+        segmentation = SegmentationWorker(
+            MRI_FILE_PATH,
+            crop=not args.no_crop,
+            crop_margin=args.crop_margin,
+            slices=args.slices,
+        ).start()
+        segmentation.request(CUSTOM_FILTERS, REFINE)
+        mri_vtk_image = segmentation.volume_image
+        custom_mask = segmentation.wait_for_mask()
+        segmentation.send("write_mask", MASK_OUTPUT_PATH)
+    else:
+        with memory_budget.stage("itk modules"):
+            load_itk_modules()
+        # The MRI is decoded once and shared between the ITK and VTK pipelines
+        mri_image = read_image(MRI_FILE_PATH, memory_budget)
+        mri_geometry = image_geometry(mri_image)
+        intensity_range = image_intensity_range(mri_image)
+        if not args.no_crop:
+            # Segmentation and ray casting only cover the non-background box
+            with memory_budget.stage("crop"):
+                mri_image = crop_image(mri_image, margin=args.crop_margin)
+        axis = None
+        if args.slices != "3d":
+            axis = stack_axis(
+                itk.array_view_from_image(mri_image).shape, force=args.slices == "2d"
+            )
+        if axis is not None:
+            # A stack of 2D images: slices are segmented independently
+            print(f"Segmenting slices across numpy axis {axis}")
+            with memory_budget.stage("slices"):
+                slice_segmentation = SliceSegmentation(mri_image, axis, intensity_range)
+                selection = slice_segmentation.segment(CUSTOM_FILTERS, REFINE)
+        else:
+            connected_components = segment_mri_image(
+                mri_image, budget=memory_budget, intensity_range=intensity_range
+            )
 
-# Add all UI sliders for the custom volume rendering
-sl_0_custom = AddCustomSlider(
-    interactor=custom_iren,
-    value_range=(0, 1),
-    x=0.7,
-    y=0.15,
-    title="Custom Volume Opacity",
-    default_value=0.1,
-    callback=cb_opacity_custom,
-)
-sl_1_custom = AddCustomSlider(
-    interactor=custom_iren,
-    value_range=(0, 1),
-    x=0.7,
-    y=0.30,
-    title="Custom Volume Mask Highlight",
-    default_value=0.7,
-    callback=cb_opacity_mask_custom,
-)
+            # Apply connected components filters
+            cc_filters_result = custom_morpho_filters(
+                connected_components, filters=CUSTOM_FILTERS, release_data=True
+            )
+            with memory_budget.stage("mask"):
+                cc_filters_result[-1].Update()
+                selection = refine_mask(cc_filters_result[-1].GetOutput(), **REFINE)
+        mask_buffer = MaskBuffer(mri_image)
+        mask_buffer.update(selection)
+        mask_buffer.write(MASK_OUTPUT_PATH, reference=mri_geometry)
+        print(memory_budget.format_records())
+        mri_vtk_image = itk.vtk_image_from_image(mri_image)
+        custom_mask = mask_buffer.image
+
+    mesh_exporter = MeshExporter()
+
+    # Load volumes and generated custom mask
+    reader_mri = vtk.vtkTrivialProducer()
+    reader_mri.SetOutput(mri_vtk_image)
+
+    custom_volume = load_custom_volume(reader_mri)
+    custom_volume_property = custom_volume.GetProperty()
+    custom_volume_mapper = custom_volume.GetMapper()
+
+    data_min_val, data_max_val = mri_vtk_image.GetScalarRange()
+    seg_min_val, seg_max_val, custom_opacity_function = set_custom_transfer_functions(
+        custom_volume_property, data_max_val
+    )
 
-sl_2_custom = AddCustomSlider(
-    interactor=custom_iren,
-    value_range=(0, 20),
-    x=0.7,
-    y=0.55,
-    title="2. Custom NB Final Components",
-    default_value=3,
-    callback=cb_custom_morpho_filters(2),
-    integer_steps=True,
-)
-sl_3_custom = AddCustomSlider(
-    interactor=custom_iren,
-    value_range=(1, 20),
-    x=0.7,
-    y=0.70,
-    title="1. Custom NB Bumpiest",
-    default_value=5,
-    callback=cb_custom_morpho_filters(1),
-    integer_steps=True,
-)
-sl_4_custom = AddCustomSlider(
-    interactor=custom_iren,
-    value_range=(1, 20),
-    x=0.7,
-    y=0.85,
-    title="0. Custom NB Biggest Components",
-    default_value=10,
-    callback=cb_custom_morpho_filters(0),
-    integer_steps=True,
-)
+    # Apply generated custom mask; the buffer is updated in place afterwards
+    # (or swapped for the worker's newest mask)
+    custom_volume_mapper.SetMaskInput(custom_mask)
+
+    custom_ren = vtkRenderer()
+    custom_ren.AddVolume(custom_volume)
+    perf_hud = PerfHud(custom_ren, visible=args.hud)
+
+    custom_renWin = vtkRenderWindow()
+    custom_renWin.AddRenderer(custom_ren)
+
+    custom_iren = vtkRenderWindowInteractor()
+    custom_iren.SetRenderWindow(custom_renWin)
+
+    custom_iren.AddObserver("ExitEvent", OnCustomClose)
+    custom_iren.AddObserver("KeyPressEvent", OnCustomKeyPress)
+    if segmentation is not None:
+        custom_iren.AddObserver("TimerEvent", on_segmentation_timer)
+
+    # Add all UI sliders for the custom volume rendering
+    sl_0_custom = AddCustomSlider(
+        interactor=custom_iren,
+        value_range=(0, 1),
+        x=0.7,
+        y=0.15,
+        title="Custom Volume Opacity",
+        default_value=0.1,
+        callback=cb_opacity_custom,
+    )
+    sl_1_custom = AddCustomSlider(
+        interactor=custom_iren,
+        value_range=(0, 1),
+        x=0.7,
+        y=0.30,
+        title="Custom Volume Mask Highlight",
+        default_value=0.7,
+        callback=cb_opacity_mask_custom,
+    )
+
+    sl_2_custom = AddCustomSlider(
+        interactor=custom_iren,
+        value_range=(0, 20),
+        x=0.7,
+        y=0.55,
+        title="2. Custom NB Final Components",
+        default_value=3,
+        callback=cb_custom_morpho_filters(2),
+        integer_steps=True,
+    )
+    sl_3_custom = AddCustomSlider(
+        interactor=custom_iren,
+        value_range=(1, 20),
+        x=0.7,
+        y=0.70,
+        title="1. Custom NB Bumpiest",
+        default_value=5,
+        callback=cb_custom_morpho_filters(1),
+        integer_steps=True,
+    )
+    sl_4_custom = AddCustomSlider(
+        interactor=custom_iren,
+        value_range=(1, 20),
+        x=0.7,
+        y=0.85,
+        title="0. Custom NB Biggest Components",
+        default_value=10,
+        callback=cb_custom_morpho_filters(0),
+        integer_steps=True,
+    )
+    sl_5_custom = AddCustomSlider(
+        interactor=custom_iren,
+        value_range=(0, 5),
+        x=0.05,
+        y=0.15,
+        title="3. Refine Radius (close, fill, open)",
+        default_value=0,
+        callback=cb_custom_refine,
+        integer_steps=True,
+    )
+    custom_sliders = {
+        "sl_0_custom": (sl_0_custom, False),
+        "sl_1_custom": (sl_1_custom, False),
+        "sl_2_custom": (sl_2_custom, True),
+        "sl_3_custom": (sl_3_custom, True),
+        "sl_4_custom": (sl_4_custom, True),
+        "sl_5_custom": (sl_5_custom, True),
+    }
+
+    if args.record:
+        recorder = Recorder(args.record, "sample")
+        for name, (slider_widget, integer_steps) in custom_sliders.items():
+            recorder.attach_slider(slider_widget, name, integer_steps)
+        recorder.attach_keys(custom_iren)
+
+    if args.replay:
+        # Events go through the same slider widgets / key observers, each
+        # timed up to its rendered frame
+        custom_renWin.SetOffScreenRendering(1)
+
+        def dispatch(event):
+            if event["event"] == "slider":
+                slider_widget, _ = custom_sliders[event["args"]["name"]]
+                slider_widget.GetSliderRepresentation().SetValue(event["args"]["value"])
+                slider_widget.InvokeEvent("InteractionEvent")
+            elif event["event"] == "key":
+                custom_iren.SetKeySym(event["args"]["key"])
+                custom_iren.InvokeEvent("KeyPressEvent")
+
+        worker_errors = []
+
+        def render():
+            # With the worker, an event's frame is the one showing its mask,
+            # after its reports ('s', 'w') are in
+            if segmentation is not None:
+                mask = segmentation.wait_for_mask()
+                segmentation.wait_for_reports()
+                if mask is not None:
+                    custom_volume_mapper.SetMaskInput(mask)
+                for message in segmentation.messages:
+                    if message[0] == "error":
+                        worker_errors.append(f"Segmentation worker: {message[1]}")
+                    else:
+                        _report_worker_message(message)
+                segmentation.messages.clear()
+            custom_renWin.Render()
+
+        custom_renWin.Render()
+        latencies, errors = replay(
+            read_events(args.replay, "sample"), dispatch, render, args.realtime
+        )
+        errors += worker_errors
+        mesh_exporter.shutdown()
+        if segmentation is not None:
+            segmentation.shutdown()
+        if slice_segmentation is not None:
+            slice_segmentation.close()
+        sys.exit(
+            finish_replay(
+                latency_report(latencies),
+                args.baseline,
+                args.save_baseline,
+                args.tolerance,
+                errors,
+            )
+        )
 
-# Launch the custom volume rendering app
-custom_iren.Initialize()
-custom_renWin.Render()
-custom_iren.Start()
+    # Launch the custom volume rendering app
+    custom_iren.Initialize()
+    if segmentation is not None:
+        custom_iren.CreateRepeatingTimer(WORKER_POLL_MS)
+    custom_renWin.Render()
+    custom_iren.Start()
+    mesh_exporter.shutdown()
+    if segmentation is not None:
+        segmentation.shutdown()
+    if slice_segmentation is not None:
+        slice_segmentation.close()
@@ -176,6 +176,7 @@ class MainWindow(Qt.QMainWindow):
         import sys
 
 
+import os
 import vtk
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5 import Qt
@@ -183,6 +184,15 @@ from PyQt5 import Qt
 from vtk.qt.QVTKRenderWindowInteractor import QVTKRenderWindowInteractor
 import itk
 
+from autocrop import crop_vtk_reader
+from dataset_catalog import DatasetCatalog, describe_entry
+from datasets import DATA_DIR
+from execution_config import ExecutionConfig
+from interaction_replay import Recorder
+from perf_hud import PerfHud
+from vtk_cache import VtkCache
+
+CATALOG_THUMBNAIL_PIXELS = 160
 
 """
     The Qt MainWindow class
@@ -202,6 +212,9 @@ class MainWindow(Qt.QMainWindow):
         self.frame.setLayout(self.mainLayout)
         self.setCentralWidget(self.frame)
 
+        # Legacy .vtk inputs are parsed once and then read from a binary cache
+        self.vtk_cache = VtkCache()
+
         """ Step 2: Add a vtk widget to the central widget """
         # As we use QHBoxLayout, the vtk widget will be automatically moved to the left
         self.vtkWidget = QVTKRenderWindowInteractor(self.frame)
@@ -242,6 +255,7 @@ class MainWindow(Qt.QMainWindow):
         # nature of the events.
         self.ren = vtk.vtkRenderer()
         self.vtkWidget.GetRenderWindow().AddRenderer(self.ren)
+        self.perf_hud = PerfHud(self.ren)
         self.iren = self.vtkWidget.GetRenderWindow().GetInteractor()
         colors = vtk.vtkNamedColors()
         self.ren.SetBackground(
@@ -318,6 +332,13 @@ class MainWindow(Qt.QMainWindow):
         self.ui_open_button.clicked.connect(self.open_vtk_file)
         self.ui_open_button.show()
         groupBox_layout.addWidget(self.ui_open_button)
+        self.ui_crop_checkbox = Qt.QCheckBox("Crop to non-background region")
+        self.ui_crop_checkbox.setChecked(True)
+        groupBox_layout.addWidget(self.ui_crop_checkbox)
+        self.ui_hud_checkbox = Qt.QCheckBox("Show performance HUD")
+        self.ui_hud_checkbox.setChecked(False)
+        self.ui_hud_checkbox.toggled.connect(self.on_hud_checkbox_change)
+        groupBox_layout.addWidget(self.ui_hud_checkbox)
 
         """ Add the min, max scalar labels """
         self.ui_min_label = Qt.QLabel("Min Scalar: 0")
@@ -405,6 +426,90 @@ class MainWindow(Qt.QMainWindow):
         x_slider_widget.setLayout(hbox)
         groupBox_layout.addWidget(x_slider_widget)
 
+        self.add_catalog_controls()
+
+    def add_catalog_controls(self):
+        """Dataset catalog: header metadata and a thumbnail of every file in a
+        folder, before anything is loaded"""
+        groupBox = Qt.QGroupBox("Dataset catalog")
+        groupBox_layout = Qt.QVBoxLayout()
+        groupBox.setLayout(groupBox_layout)
+        self.right_panel_layout.addWidget(groupBox)
+
+        hbox = Qt.QHBoxLayout()
+        self.ui_catalog_dir = Qt.QLineEdit(DATA_DIR)
+        hbox.addWidget(self.ui_catalog_dir)
+        self.ui_catalog_scan_button = Qt.QPushButton("Scan")
+        self.ui_catalog_scan_button.clicked.connect(
+            lambda: self.show_catalog(self.ui_catalog_dir.text())
+        )
+        hbox.addWidget(self.ui_catalog_scan_button)
+        catalog_dir_widget = Qt.QWidget()
+        catalog_dir_widget.setLayout(hbox)
+        groupBox_layout.addWidget(catalog_dir_widget)
+
+        # Selecting a file shows its header; double click opens it
+        self.ui_catalog_list = Qt.QListWidget()
+        self.ui_catalog_list.currentItemChanged.connect(self.on_catalog_item_change)
+        self.ui_catalog_list.itemDoubleClicked.connect(
+            lambda item: self.ui_open_button.click()
+        )
+        groupBox_layout.addWidget(self.ui_catalog_list)
+        hbox = Qt.QHBoxLayout()
+        self.ui_catalog_thumbnail = Qt.QLabel()
+        self.ui_catalog_thumbnail.setFixedSize(
+            CATALOG_THUMBNAIL_PIXELS, CATALOG_THUMBNAIL_PIXELS
+        )
+        hbox.addWidget(self.ui_catalog_thumbnail)
+        self.ui_catalog_info = Qt.QLabel()
+        self.ui_catalog_info.setWordWrap(True)
+        hbox.addWidget(self.ui_catalog_info)
+        catalog_info_widget = Qt.QWidget()
+        catalog_info_widget.setLayout(hbox)
+        groupBox_layout.addWidget(catalog_info_widget)
+
+        if os.path.isdir(DATA_DIR):
+            self.show_catalog(DATA_DIR)
+
+    def show_catalog(self, directory, select=None):
+        # Only new or modified files have their header parsed again
+        self.catalog = DatasetCatalog(directory)
+        self.catalog.refresh()
+        self.ui_catalog_dir.setText(self.catalog.root)
+        self.ui_catalog_list.clear()
+        for relative in sorted(self.catalog.entries):
+            item = Qt.QListWidgetItem(relative)
+            item.setData(QtCore.Qt.UserRole, relative)
+            self.ui_catalog_list.addItem(item)
+            if select and os.path.samefile(self.catalog.path(relative), select):
+                self.ui_catalog_list.setCurrentItem(item)
+
+    def on_catalog_item_change(self, item, previous=None):
+        if item is None:
+            return
+        relative = item.data(QtCore.Qt.UserRole)
+        entry = self.catalog.entries[relative]
+        self.ui_catalog_info.setText(describe_entry(entry))
+        self.ui_file_name.setText(self.catalog.path(relative))
+
+        thumbnail = self.catalog.thumbnail(relative)
+        if thumbnail is None:
+            self.ui_catalog_thumbnail.setText("no preview")
+            return
+        height, width = thumbnail.shape
+        image = Qt.QImage(
+            thumbnail.tobytes(), width, height, width, Qt.QImage.Format_Grayscale8
+        )
+        # Rows run bottom-up in the volume
+        pixmap = Qt.QPixmap.fromImage(image.mirrored(False, True))
+        self.ui_catalog_thumbnail.setPixmap(
+            pixmap.scaled(
+                CATALOG_THUMBNAIL_PIXELS,
+                CATALOG_THUMBNAIL_PIXELS,
+                QtCore.Qt.KeepAspectRatio,
+            )
+        )
+
     def on_file_browser_clicked(self):
         dlg = Qt.QFileDialog()
         dlg.setFileMode(Qt.QFileDialog.AnyFile)
@@ -413,6 +518,8 @@ class MainWindow(Qt.QMainWindow):
         if dlg.exec_():
             filenames = dlg.selectedFiles()
             self.ui_file_name.setText(filenames[0])
+            # Show the chosen file's header and thumbnail before it is opened
+            self.show_catalog(os.path.dirname(filenames[0]), select=filenames[0])
 
     def open_vtk_file(self):
         """Read and verify the vtk input file"""
@@ -425,10 +532,15 @@ class MainWindow(Qt.QMainWindow):
             self.reader.Update()
         elif ".vtk" in input_file_name:  # The input file is VTK
             self.input_type = "vtk"
-            self.reader = vtk.vtkDataSetReader()
-            self.reader.SetFileName(input_file_name)
-            self.reader.Update()
-            self.reader.GetOutput().GetPointData().SetActiveScalars("s")
+            self.reader = self.vtk_cache.reader(input_file_name, active_scalars="s")
+
+        # The color table range comes from the whole volume; slicing and
+        # color mapping then only cover the non-background box
+        full_scalar_range = self.reader.GetOutput().GetScalarRange()
+        if self.ui_crop_checkbox.isChecked() and self.reader.GetOutput().IsA(
+            "vtkImageData"
+        ):
+            self.reader = crop_vtk_reader(self.reader, background=full_scalar_range[0])
 
         # Some initialization to remove actors that are created previously
         if hasattr(self, "isoSurf_actor"):
@@ -448,10 +560,7 @@ class MainWindow(Qt.QMainWindow):
 
         # You probably need to remove additional actors below...
 
-        self.scalar_range = [
-            self.reader.GetOutput().GetScalarRange()[0],
-            self.reader.GetOutput().GetScalarRange()[1],
-        ]
+        self.scalar_range = [full_scalar_range[0], full_scalar_range[1]]
         self.ui_min_label.setText("Min Scalar:" + str(self.scalar_range[0]))
         self.ui_max_label.setText("Max Scalar:" + str(self.scalar_range[1]))
 
@@ -603,7 +712,9 @@ class MainWindow(Qt.QMainWindow):
             xy_plane_Colors = vtk.vtkImageMapToColors()
             xy_plane_Colors.SetInputConnection(self.reader.GetOutputPort())
             xy_plane_Colors.SetLookupTable(self.bwLut)
-            xy_plane_Colors.Update()
+            self.perf_hud.mark_update()
+            with self.perf_hud.stage("color map"):
+                xy_plane_Colors.Update()
 
             if hasattr(self, "xy_plane"):
                 self.ren.RemoveActor(self.xy_plane)
@@ -629,7 +740,9 @@ class MainWindow(Qt.QMainWindow):
             xz_plane_Colors = vtk.vtkImageMapToColors()
             xz_plane_Colors.SetInputConnection(self.reader.GetOutputPort())
             xz_plane_Colors.SetLookupTable(self.bwLut)
-            xz_plane_Colors.Update()
+            self.perf_hud.mark_update()
+            with self.perf_hud.stage("color map"):
+                xz_plane_Colors.Update()
 
             if hasattr(self, "xz_plane"):
                 self.ren.RemoveActor(self.xz_plane)
@@ -655,7 +768,9 @@ class MainWindow(Qt.QMainWindow):
             yz_plane_Colors = vtk.vtkImageMapToColors()
             yz_plane_Colors.SetInputConnection(self.reader.GetOutputPort())
             yz_plane_Colors.SetLookupTable(self.bwLut)
-            yz_plane_Colors.Update()
+            self.perf_hud.mark_update()
+            with self.perf_hud.stage("color map"):
+                yz_plane_Colors.Update()
 
             if hasattr(self, "yz_plane"):
                 self.ren.RemoveActor(self.yz_plane)
@@ -673,6 +788,10 @@ class MainWindow(Qt.QMainWindow):
             # Re-render the screen
             self.vtkWidget.GetRenderWindow().Render()
 
+    def on_hud_checkbox_change(self):
+        self.perf_hud.set_visible(self.ui_hud_checkbox.isChecked())
+        self.vtkWidget.GetRenderWindow().Render()
+
     """ Handle the click event for the submit button  """
 
     def on_submit_clicked(self):
@@ -719,6 +838,12 @@ class MainWindow(Qt.QMainWindow):
 
 
 if __name__ == "__main__":
+    # Thread counts / core pinning from VIS_THREADS, VIS_STAGE_THREADS and
+    # VIS_PIN_CORES
+    ExecutionConfig.from_env().apply()
     app = Qt.QApplication(sys.argv)
     window = MainWindow()
+    if os.environ.get("VIS_RECORD"):
+        # Replay with: python interaction_replay.py $VIS_RECORD
+        Recorder(os.environ["VIS_RECORD"], "sample2").attach_qt(window)
     sys.exit(app.exec_())
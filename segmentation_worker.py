@@ -0,0 +1,380 @@
+import multiprocessing
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+"""
+    Out-of-process segmentation for the viewer.
+    A long-lived worker process decodes the volume, labels its components and
+    answers parameter changes sent over a pipe. The volume and two mask
+    buffers live in shared memory owned by the viewer, which maps them as VTK
+    images without copying: the worker writes a new mask into the buffer
+    that is not on screen, the viewer swaps it in and hands the old one back.
+    Requests that arrive while the worker is busy are coalesced, and a worker
+    that dies is restarted while the viewer keeps its last mask.
+"""
+
+WORKER_POLL_MS = 30
+WORKER_START_TIMEOUT = 300
+WORKER_MAX_RESTARTS = 3
+
+
+def _worker_main(conn, path, crop, crop_margin, slices):
+    # Runs in the worker process
+    import itk
+    from autocrop import crop_image, crop_offset, image_geometry, uncrop_image
+    from mask_refine import refine_mask, refined_components
+    from sample import custom_morpho_filters, image_intensity_range, segment_mri_image
+    from slice_segmentation import SliceSegmentation, stack_axis
+    from tumor_stats import component_statistics, write_csv
+
+    mri = itk.imread(path)
+    geometry = image_geometry(mri)
+    intensity_range = image_intensity_range(mri)
+    if crop:
+        mri = crop_image(mri, margin=crop_margin)
+    volume = itk.array_view_from_image(mri)
+    axis = None
+    if slices != "3d":
+        axis = stack_axis(volume.shape, force=slices == "2d")
+    slice_segmentation = connected_components = None
+    if axis is not None:
+        # A stack of 2D images. A daemon process cannot start a pool, so the
+        # slices are segmented one after the other in this process
+        print(f"Segmentation worker: slices across numpy axis {axis}")
+        slice_segmentation = SliceSegmentation(mri, axis, intensity_range, 1)
+    else:
+        connected_components = segment_mri_image(mri, intensity_range=intensity_range)
+    conn.send(
+        (
+            "geometry",
+            {
+                "shape": volume.shape,
+                "dtype": volume.dtype.str,
+                "origin": tuple(mri.GetOrigin()),
+                "spacing": tuple(mri.GetSpacing()),
+                "direction": tuple(itk.array_from_matrix(mri.GetDirection()).ravel()),
+            },
+        )
+    )
+
+    _, names, shown, volume_ready = conn.recv()
+    # Spawned workers share the viewer's resource tracker, so attaching does
+    # not make the blocks go away with the worker
+    blocks = [shared_memory.SharedMemory(name=name) for name in names]
+    if not volume_ready:
+        np.ndarray(volume.shape, volume.dtype, blocks[0].buf)[...] = volume
+    masks = [np.ndarray(volume.shape, np.uint8, block.buf) for block in blocks[1:]]
+    # The buffer on screen is only written after the viewer releases it
+    free = {0, 1} - {shown}
+    conn.send(("ready",))
+
+    # Labels of the published mask, the filters they come from and the
+    # refined mask (None when the request had no refinement)
+    selection = pipeline = refined = published = None
+    pending = None
+    while True:
+        message = conn.recv() if pending is None or not free else None
+        while message is not None or conn.poll():
+            if message is None:
+                message = conn.recv()
+            kind = message[0]
+            if kind == "params":
+                pending = message
+            elif kind == "release":
+                free.add(message[1])
+            elif kind in ("stats", "write_mask") and selection is None:
+                conn.send(("error", f"No mask yet for '{kind}'"))
+            elif kind == "stats":
+                try:
+                    # The statistics describe the mask on screen
+                    labels = selection
+                    if refined is not None:
+                        labels = refined_components(refined)
+                    stats = component_statistics(
+                        labels,
+                        mri,
+                        index_offset=crop_offset(mri, geometry),
+                    )
+                    write_csv(stats, message[1])
+                except Exception as e:
+                    conn.send(("error", f"Statistics failed: {e!r}"))
+                else:
+                    conn.send(("stats", message[1], stats["components"]))
+            elif kind == "write_mask":
+                # The newest mask; only this process writes the buffers
+                try:
+                    mask = itk.image_view_from_array(masks[published])
+                    mask.CopyInformation(mri)
+                    itk.imwrite(uncrop_image(mask, geometry), message[1])
+                except Exception as e:
+                    conn.send(("error", f"Writing the mask failed: {e!r}"))
+                else:
+                    conn.send(("written", message[1]))
+            elif kind == "stop":
+                return
+            message = None
+
+        if pending is not None and free:
+            _, request_id, filters, refine = pending
+            pending = None
+            started = time.perf_counter()
+            try:
+                if slice_segmentation is not None:
+                    # One mask for the stack, reported as a single component
+                    computed = None
+                    labels = mask_image = slice_segmentation.segment(filters, refine)
+                else:
+                    computed = custom_morpho_filters(
+                        connected_components, filters=filters, release_data=True
+                    )
+                    computed[-1].Update()
+                    labels = computed[-1].GetOutput()
+                    mask_image = refine_mask(labels, **refine)
+            except Exception as e:
+                # The viewer keeps its mask; the worker keeps serving
+                conn.send(("failed", request_id, f"Request failed: {e!r}"))
+                continue
+            selection, pipeline = labels, computed
+            refined = None
+            if slice_segmentation is None and any(refine.values()):
+                refined = mask_image
+            published = free.pop()
+            np.not_equal(itk.array_view_from_image(mask_image), 0, out=masks[published])
+            conn.send(("mask", published, request_id, time.perf_counter() - started))
+
+
+def _vtk_image(array, geometry):
+    # VTK image over array's memory (no copy); the VTK array keeps a
+    # reference to the numpy array
+    image = vtk.vtkImageData()
+    image.SetDimensions(array.shape[::-1])
+    image.SetOrigin(geometry["origin"])
+    image.SetSpacing(geometry["spacing"])
+    image.SetDirectionMatrix(geometry["direction"])
+    scalars = numpy_support.numpy_to_vtk(array.reshape(-1), deep=False)
+    image.GetPointData().SetScalars(scalars)
+    return image
+
+
+class SegmentationWorker:
+    def __init__(self, path, crop=True, crop_margin=0, slices="auto"):
+        # slices: "auto", "2d" or "3d", as sample.py --slices
+        self.args = (path, crop, crop_margin, slices)
+        self.context = multiprocessing.get_context("spawn")
+        self.blocks = []
+        self.volume_image = None
+        self.mask_images = []
+        self.shown = None
+        self.requested = 0
+        self.received = 0
+        self.last_request = None
+        self.last_shown_request = None
+        self.sent_requests = {}
+        self.last_seconds = None
+        # 'stats' / 'write_mask' requests not answered yet
+        self.pending_reports = 0
+        self.restarts = 0
+        self.stopped = False
+        self.messages = []
+        self.process = None
+
+    def start(self, timeout=WORKER_START_TIMEOUT):
+        # Blocks until the volume is mapped (the viewer needs it to draw)
+        self._spawn()
+        deadline = time.monotonic() + timeout
+        while self.volume_image is None:
+            if not self.conn.poll(max(deadline - time.monotonic(), 0)):
+                raise TimeoutError(f"Segmentation worker not ready after {timeout} s")
+            self._handle(self.conn.recv())
+        return self
+
+    def _spawn(self):
+        self.conn, worker_conn = self.context.Pipe()
+        self.process = self.context.Process(
+            target=_worker_main, args=(worker_conn,) + self.args, daemon=True
+        )
+        self.process.start()
+        worker_conn.close()
+
+    def _handle(self, message):
+        # Returns the mask image to show for a "mask" message, else None
+        kind = message[0]
+        if kind == "geometry":
+            volume_ready = bool(self.blocks)
+            if not volume_ready:
+                self._allocate(message[1])
+            names = [block.name for block in self.blocks]
+            self.conn.send(("buffers", names, self.shown, volume_ready))
+        elif kind == "ready" and self.last_shown_request is not None:
+            # A restarted worker recomputes the parameters on screen (never
+            # a request it may have died on)
+            self.conn.send(self.last_shown_request)
+        elif kind == "mask":
+            _, buffer, request_id, seconds = message
+            self.received = max(self.received, request_id)
+            # A restarted worker answers with the id of the request it resent
+            self.last_shown_request = self.sent_requests.get(
+                request_id, self.last_shown_request
+            )
+            self._forget_requests(request_id)
+            self.last_seconds = seconds
+            if self.shown is not None:
+                self.conn.send(("release", self.shown))
+            self.shown = buffer
+            image = self.mask_images[buffer]
+            image.GetPointData().GetScalars().Modified()
+            image.Modified()
+            return image
+        elif kind == "failed":
+            _, request_id, text = message
+            self.received = max(self.received, request_id)
+            self._forget_requests(request_id)
+            self.messages.append(("error", text))
+        elif kind in ("stats", "written", "error"):
+            self.pending_reports = max(self.pending_reports - 1, 0)
+            self.messages.append(message)
+        return None
+
+    def _forget_requests(self, request_id):
+        # Requests up to request_id were answered or coalesced away
+        for sent in [i for i in self.sent_requests if i <= request_id]:
+            del self.sent_requests[sent]
+
+    def _allocate(self, geometry):
+        dtype = np.dtype(geometry["dtype"])
+        shape = geometry["shape"]
+        voxels = int(np.prod(shape))
+        self.blocks = [
+            shared_memory.SharedMemory(create=True, size=voxels * dtype.itemsize),
+            shared_memory.SharedMemory(create=True, size=voxels),
+            shared_memory.SharedMemory(create=True, size=voxels),
+        ]
+        volume = np.ndarray(shape, dtype, self.blocks[0].buf)
+        self.volume_image = _vtk_image(volume, geometry)
+        self.mask_images = [
+            _vtk_image(np.ndarray(shape, np.uint8, block.buf), geometry)
+            for block in self.blocks[1:]
+        ]
+
+    def request(self, filters, refine):
+        # Non-blocking; only the newest request is computed when several queue
+        self.requested += 1
+        # Slider values arrive as floats; counts and radii are whole numbers
+        filters = [(attribute, round(n), reverse) for attribute, n, reverse in filters]
+        refine = {
+            "fill_holes": bool(refine["fill_holes"]),
+            "closing_radius": round(refine["closing_radius"]),
+            "opening_radius": round(refine["opening_radius"]),
+        }
+        self.last_request = ("params", self.requested, filters, refine)
+        self.sent_requests[self.requested] = self.last_request
+        self._send(self.last_request)
+
+    def send(self, *message):
+        if message[0] in ("stats", "write_mask"):
+            self.pending_reports += 1
+        self._send(message)
+
+    def _send(self, message):
+        try:
+            self.conn.send(message)
+        except OSError:
+            # Picked up by the next poll()
+            pass
+
+    def poll(self):
+        # Handles what the worker sent; returns the newest mask image, or None.
+        # Call from a timer in the viewer, it never waits for the worker
+        image = None
+        if self.stopped:
+            return None
+        try:
+            while self.conn.poll():
+                image = self._handle(self.conn.recv()) or image
+        except (EOFError, OSError):
+            pass
+        if not self.process.is_alive():
+            self._restart()
+        return image
+
+    def wait_for_mask(self, timeout=WORKER_START_TIMEOUT):
+        # Blocks until the newest request is on screen; None if it already is
+        return self._wait(lambda: self.received < self.requested, "mask", timeout)
+
+    def wait_for_reports(self, timeout=WORKER_START_TIMEOUT):
+        # Blocks until every 'stats' / 'write_mask' sent has been answered
+        self._wait(lambda: self.pending_reports > 0, "report", timeout)
+
+    def _wait(self, waiting, what, timeout):
+        image = None
+        deadline = time.monotonic() + timeout
+        while waiting():
+            image = self.poll() or image
+            if self.stopped:
+                raise RuntimeError(
+                    f"Segmentation worker stopped after {self.restarts} restarts"
+                )
+            if time.monotonic() >= deadline:
+                raise TimeoutError(
+                    f"No {what} from the segmentation worker in {timeout} s"
+                )
+            if waiting():
+                self.conn.poll(WORKER_POLL_MS / 1000)
+        return image
+
+    def _restart(self):
+        exitcode = self.process.exitcode
+        if self.received < self.requested:
+            # Died computing: that request is dropped rather than resent
+            self.received = self.requested
+            self.sent_requests.clear()
+            self.messages.append(
+                (
+                    "error",
+                    f"Worker exited with code {exitcode} on request {self.requested}",
+                )
+            )
+        if self.pending_reports:
+            self.messages.append(
+                ("error", f"Worker exited before {self.pending_reports} reports")
+            )
+            self.pending_reports = 0
+        self.conn.close()
+        if self.restarts >= WORKER_MAX_RESTARTS:
+            # Reported once; poll() does nothing from now on
+            self.stopped = True
+            self.messages.append(
+                (
+                    "error",
+                    f"Worker exited with code {exitcode} after {self.restarts} "
+                    "restarts, not restarting; the last mask stays on screen",
+                )
+            )
+            return
+        self.restarts += 1
+        print(
+            f"Segmentation worker exited with code {exitcode}, "
+            f"restarting ({self.restarts}/{WORKER_MAX_RESTARTS})"
+        )
+        self._spawn()
+
+    def shutdown(self):
+        if self.process is not None and self.process.is_alive():
+            self._send(("stop",))
+            self.process.join(5)
+            if self.process.is_alive():
+                self.process.terminate()
+        self.volume_image = None
+        self.mask_images = []
+        for block in self.blocks:
+            try:
+                block.close()
+            except BufferError:
+                # Still mapped by a VTK image; freed with the process
+                pass
+            block.unlink()
+        self.blocks = []
@@ -0,0 +1,267 @@
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import itk
+
+from datasets import DATA_DIR, THIN_AXIS_RATIO
+from dtype_planner import compact_labels, planned_connected_components
+from execution_config import ExecutionConfig, available_cores, stage_thread_count
+from fused_threshold import filter_chain_binary, fusable, fused_threshold, raw_cutoff
+from mask_refine import refine_box
+
+"""
+    Slice-parallel segmentation of stacks of 2D images.
+    Volumes with one very thin axis (e.g. 3 x 612 x 630) are stacks of
+    independent images rather than one connected volume. Each slice across
+    that axis goes through its own threshold, connected components, component
+    selection and refinement, and the 0/1 masks are written back into one
+    volume. Slices are split into chunks over a pool of processes that read
+    the volume from, and write the mask to, shared memory.
+"""
+
+SLICE_CHUNKS_PER_PROCESS = 4
+
+# Views of the shared volume and mask in a pool process, slices first
+_blocks = []
+_volume = _mask = None
+
+
+def stack_axis(shape, force=False):
+    # numpy axis of a (z, y, x) volume along which it is a stack of 2D
+    # images: one far thinner than the largest, or the thinnest when forced.
+    # None for a real 3D volume
+    axis = int(np.argmin(shape))
+    if force or shape[axis] < THIN_AXIS_RATIO * max(shape):
+        return axis
+    return None
+
+
+def segment_plane(plane, intensity_range, filters, refine=None, lower=102):
+    # Boolean mask of one 2D image, through the same stages as the 3D chain
+    from sample import custom_morpho_filters
+
+    image = itk.image_view_from_array(np.ascontiguousarray(plane))
+    if fusable(image):
+        binary = fused_threshold(
+            image,
+            raw_cutoff(intensity_range, lower),
+            slab_slices=plane.shape[0],
+            threads=1,
+        )
+    else:
+        binary = filter_chain_binary(image, intensity_range, lower)
+    connected_components = planned_connected_components(binary)
+    labels = connected_components.GetOutput()
+    compact = compact_labels(labels, connected_components.GetObjectCount())
+    if compact is not None:
+        compact.Update()
+        labels = compact.GetOutput()
+    selection = custom_morpho_filters(labels, filters)
+    selection[-1].Update()
+    mask = itk.array_view_from_image(selection[-1].GetOutput()) != 0
+    if refine:
+        mask = refine_box(
+            mask,
+            refine.get("fill_holes", False),
+            refine.get("closing_radius", 0),
+            refine.get("opening_radius", 0),
+        )
+    return mask
+
+
+def _segment_slices(volume, mask, start, stop, intensity_range, filters, refine):
+    for index in range(start, stop):
+        mask[index] = segment_plane(volume[index], intensity_range, filters, refine)
+
+
+def _attach(names, shape, dtype, axis):
+    # Pool initializer: the parallelism is across slices, so every process
+    # runs its filters on one thread
+    global _blocks, _volume, _mask
+    ExecutionConfig(threads=1).apply()
+    _blocks = [shared_memory.SharedMemory(name=name) for name in names]
+    _volume = np.moveaxis(np.ndarray(shape, dtype, _blocks[0].buf), axis, 0)
+    _mask = np.moveaxis(np.ndarray(shape, np.uint8, _blocks[1].buf), axis, 0)
+
+
+def _segment_chunk(start, stop, intensity_range, filters, refine):
+    _segment_slices(_volume, _mask, start, stop, intensity_range, filters, refine)
+    return stop - start
+
+
+class SliceSegmentation:
+    def __init__(self, image, axis, intensity_range=None, processes=None):
+        # image: ITK volume, segmented slice by slice across numpy axis
+        from sample import image_intensity_range
+
+        self.axis = axis
+        self.intensity_range = intensity_range or image_intensity_range(image)
+        volume = itk.array_view_from_image(image)
+        self.slices = volume.shape[axis]
+        self.processes = min(processes or stage_thread_count("slices"), self.slices)
+        self.blocks = []
+        self.pool = None
+        if self.processes > 1:
+            # Pool processes get the volume through shared memory, not pickled
+            self.blocks = [
+                shared_memory.SharedMemory(create=True, size=volume.nbytes),
+                shared_memory.SharedMemory(create=True, size=volume.size),
+            ]
+            shared = np.ndarray(volume.shape, volume.dtype, self.blocks[0].buf)
+            shared[...] = volume
+            volume = shared
+            mask_array = np.ndarray(volume.shape, np.uint8, self.blocks[1].buf)
+            self.pool = ProcessPoolExecutor(
+                self.processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_attach,
+                initargs=(
+                    [block.name for block in self.blocks],
+                    volume.shape,
+                    volume.dtype.str,
+                    axis,
+                ),
+            )
+        else:
+            mask_array = np.zeros(volume.shape, np.uint8)
+        self.volume = np.moveaxis(volume, axis, 0)
+        self.mask_array = np.moveaxis(mask_array, axis, 0)
+        self.mask = itk.image_view_from_array(mask_array)
+        self.mask.CopyInformation(image)
+
+    def chunks(self):
+        # Several chunks per process so uneven slices balance out
+        count = min(self.slices, self.processes * SLICE_CHUNKS_PER_PROCESS)
+        bounds = np.linspace(0, self.slices, count + 1).astype(int)
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def segment(self, filters, refine=None):
+        # Returns the 0/1 uchar mask image, rewritten in place on every call
+        # Slider values arrive as floats; the counts are whole numbers
+        filters = [(attribute, round(n), reverse) for attribute, n, reverse in filters]
+        if refine is not None and not any(refine.values()):
+            refine = None
+        if self.pool is None:
+            _segment_slices(
+                self.volume,
+                self.mask_array,
+                0,
+                self.slices,
+                self.intensity_range,
+                filters,
+                refine,
+            )
+        else:
+            futures = [
+                self.pool.submit(
+                    _segment_chunk,
+                    int(start),
+                    int(stop),
+                    self.intensity_range,
+                    filters,
+                    refine,
+                )
+                for start, stop in self.chunks()
+            ]
+            for future in futures:
+                future.result()
+        self.mask.Modified()
+        return self.mask
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        self.volume = self.mask_array = self.mask = None
+        for block in self.blocks:
+            try:
+                block.close()
+            except BufferError:
+                # Still mapped by an image; freed with the process
+                pass
+            block.unlink()
+        self.blocks = []
+
+
+def benchmark(path, process_counts, filters, repeats=3, axis=None):
+    # Seconds per segmentation for each process count, and whether every
+    # count gives the same mask as one process
+    from sample import image_intensity_range
+
+    image = itk.imread(path)
+    intensity_range = image_intensity_range(image)
+    if axis is None:
+        axis = stack_axis(itk.array_view_from_image(image).shape, force=True)
+    rows = []
+    reference = None
+    for processes in process_counts:
+        slices = SliceSegmentation(image, axis, intensity_range, processes)
+        try:
+            # The first call starts the pool processes (and imports ITK there)
+            slices.segment(filters)
+            times = []
+            for _ in range(repeats):
+                started = time.perf_counter()
+                mask = itk.array_from_image(slices.segment(filters))
+                times.append(time.perf_counter() - started)
+        finally:
+            slices.close()
+        if reference is None:
+            reference = mask
+        rows.append(
+            {
+                "processes": slices.processes,
+                "seconds": min(times),
+                "identical": bool(np.array_equal(mask, reference)),
+                "voxels": int(np.count_nonzero(mask)),
+            }
+        )
+    return axis, rows
+
+
+if __name__ == "__main__":
+    from sample import CUSTOM_FILTERS
+
+    parser = argparse.ArgumentParser(
+        description="Segment a stack of 2D images slice by slice across processes"
+    )
+    parser.add_argument(
+        "path", nargs="?", default=os.path.join(DATA_DIR, "braintumor_image.mha")
+    )
+    parser.add_argument("--out", help="write the mask here")
+    parser.add_argument(
+        "--processes",
+        type=int,
+        nargs="+",
+        default=[1, len(available_cores())],
+        help="process counts to time",
+    )
+    parser.add_argument(
+        "--axis", type=int, default=None, help="numpy axis of the slices"
+    )
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    process_counts = sorted(set(args.processes))
+    axis, rows = benchmark(
+        args.path, process_counts, CUSTOM_FILTERS, args.repeats, args.axis
+    )
+    print(f"{os.path.basename(args.path)}: slices across numpy axis {axis}")
+    print(f"{'processes':>10}{'ms':>10}{'speedup':>10}{'voxels':>10}")
+    for row in rows:
+        print(
+            f"{row['processes']:>10}{row['seconds'] * 1000:>10.1f}"
+            f"{rows[0]['seconds'] / row['seconds']:>10.2f}{row['voxels']:>10}"
+            f"{'' if row['identical'] else '  MISMATCH'}"
+        )
+    if args.out:
+        image = itk.imread(args.path)
+        slices = SliceSegmentation(image, axis, processes=process_counts[-1])
+        itk.imwrite(slices.segment(CUSTOM_FILTERS), args.out)
+        slices.close()
+    raise SystemExit(0 if all(row["identical"] for row in rows) else 1)
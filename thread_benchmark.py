@@ -0,0 +1,194 @@
+import argparse
+import json
+import os
+import statistics
+import time
+
+import vtk
+import itk
+
+from datasets import BUNDLED_VOLUMES
+from dtype_planner import binary_mask, image_type, planned_rescale
+from execution_config import (
+    ExecutionConfig,
+    available_cores,
+    configure_stage,
+    parse_cores,
+)
+from fused_threshold import fused_threshold, raw_cutoff
+
+"""
+    Core-scaling benchmark of the pipeline stages.
+    Every stage is re-run on the same inputs for a sweep of thread counts and
+    the median time, speedup and parallel efficiency are reported per stage.
+"""
+
+
+def default_thread_counts():
+    cores = len(available_cores())
+    counts = [1]
+    while counts[-1] * 2 <= cores:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != cores:
+        counts.append(cores)
+    return counts
+
+
+def stage_inputs(path):
+    # Inputs of every stage, computed once with the default thread count
+    mri = itk.imread(path)
+    calculator = itk.MinimumMaximumImageCalculator[type(mri)].New(Image=mri)
+    calculator.Compute()
+    rescaled = planned_rescale(
+        mri, 0, 255, (calculator.GetMinimum(), calculator.GetMaximum())
+    )
+    rescaled.Update()
+    threshold = itk.ThresholdImageFilter.New(Input=rescaled, Lower=102)
+    threshold.Update()
+    in_type, dim = image_type(threshold)
+    connected_components = itk.ConnectedComponentImageFilter[
+        itk.Image[in_type, dim], itk.Image[itk.US, dim]
+    ].New(Input=threshold)
+    connected_components.Update()
+    mask = binary_mask(connected_components)
+    mask.Update()
+    return {
+        "mri": mri,
+        "intensity_range": (calculator.GetMinimum(), calculator.GetMaximum()),
+        "rescaled": rescaled.GetOutput(),
+        "binary": threshold.GetOutput(),
+        "labels": connected_components.GetOutput(),
+        "mask": itk.vtk_image_from_image(mask.GetOutput()),
+        "mri_vtk": itk.vtk_image_from_image(mri),
+    }
+
+
+def stage_runners(inputs):
+    # stage name -> function building and running the stage once
+    def rescale():
+        image_filter = planned_rescale(inputs["mri"], 0, 255, inputs["intensity_range"])
+        configure_stage("rescale", image_filter).Update()
+
+    def threshold():
+        image_filter = itk.ThresholdImageFilter.New(Input=inputs["rescaled"], Lower=102)
+        configure_stage("threshold", image_filter).Update()
+
+    def fused():
+        # fused_threshold.py, threads from the "threshold" stage
+        fused_threshold(inputs["mri"], raw_cutoff(inputs["intensity_range"], 102))
+
+    def connected_components():
+        in_type, dim = image_type(inputs["binary"])
+        image_filter = itk.ConnectedComponentImageFilter[
+            itk.Image[in_type, dim], itk.Image[itk.US, dim]
+        ].New(Input=inputs["binary"])
+        configure_stage("connected_components", image_filter).Update()
+
+    def keep_objects():
+        image_filter = itk.LabelShapeKeepNObjectsImageFilter.New(
+            Input=inputs["labels"],
+            BackgroundValue=0,
+            NumberOfObjects=10,
+            Attribute="NumberOfPixels",
+        )
+        configure_stage("keep_objects", image_filter).Update()
+
+    def mask():
+        binary_mask(inputs["labels"]).Update()
+
+    def map_to_colors():
+        # sample2.py cut-plane coloring (vtkThreadedImageAlgorithm)
+        lut = vtk.vtkLookupTable()
+        lut.SetTableRange(*inputs["mri_vtk"].GetScalarRange())
+        lut.Build()
+        colors = vtk.vtkImageMapToColors()
+        colors.SetInputData(inputs["mri_vtk"])
+        colors.SetLookupTable(lut)
+        configure_stage("render", colors).Update()
+
+    def surface():
+        # mesh_export.py surface extraction (vtkSMPTools)
+        surface_filter = vtk.vtkDiscreteFlyingEdges3D()
+        surface_filter.SetInputData(inputs["mask"])
+        surface_filter.SetValue(0, 1)
+        surface_filter.Update()
+
+    return {
+        "rescale": rescale,
+        "threshold": threshold,
+        "fused_threshold": fused,
+        "connected_components": connected_components,
+        "keep_objects": keep_objects,
+        "mask": mask,
+        "map_to_colors": map_to_colors,
+        "surface": surface,
+    }
+
+
+def time_stage(run, repeats):
+    times = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - started)
+    return statistics.median(times)
+
+
+def sweep(path, thread_counts, repeats=5, pin_cores=None):
+    inputs = stage_inputs(path)
+    runners = stage_runners(inputs)
+    rows = []
+    for threads in thread_counts:
+        ExecutionConfig(threads=threads, pin_cores=pin_cores).apply()
+        for stage, run in runners.items():
+            run()  # warm-up: wrapper loading, thread pool start
+            rows.append(
+                {
+                    "stage": stage,
+                    "threads": threads,
+                    "seconds": time_stage(run, repeats),
+                }
+            )
+    baseline = {
+        r["stage"]: r["seconds"] for r in rows if r["threads"] == thread_counts[0]
+    }
+    for row in rows:
+        row["speedup"] = baseline[row["stage"]] / row["seconds"]
+        row["efficiency"] = row["speedup"] * thread_counts[0] / row["threads"]
+    return rows
+
+
+def format_sweep(rows):
+    lines = [f"{'stage':<24}{'threads':>8}{'ms':>10}{'speedup':>9}{'eff.':>7}"]
+    for row in sorted(rows, key=lambda r: (r["stage"], r["threads"])):
+        lines.append(
+            f"{row['stage']:<24}{row['threads']:>8}{row['seconds'] * 1000:>10.2f}"
+            f"{row['speedup']:>9.2f}{row['efficiency']:>7.2f}"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Thread scaling of pipeline stages")
+    parser.add_argument("paths", nargs="*", default=BUNDLED_VOLUMES)
+    parser.add_argument(
+        "--threads",
+        type=lambda text: [int(t) for t in text.split(",")],
+        default=None,
+        help="thread counts to sweep, e.g. 1,2,4,8 (default: powers of two)",
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--pin-cores", type=parse_cores, default=None)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    thread_counts = args.threads or default_thread_counts()
+    results = {}
+    for path in args.paths:
+        rows = sweep(path, thread_counts, args.repeats, args.pin_cores)
+        results[path] = rows
+        print(f"\n{os.path.basename(path)}")
+        print(format_sweep(rows))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,199 @@
+import argparse
+import csv
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import itk
+
+from autocrop import crop_image, crop_offset
+from memory_budget import read_image
+
+"""
+    Per-component statistics of the selected tumor components.
+    One pass over the labelled volume (slab by slab, touching only foreground
+    voxels) accumulates counts, coordinate sums, bounding boxes and
+    intensities per label with bincount-style reductions.
+"""
+
+STATS_FIELDS = [
+    "label",
+    "voxels",
+    "volume_mm3",
+    "brain_fraction",
+    "centroid_x",
+    "centroid_y",
+    "centroid_z",
+    "bbox_min_x",
+    "bbox_min_y",
+    "bbox_min_z",
+    "bbox_max_x",
+    "bbox_max_y",
+    "bbox_max_z",
+    "mean_intensity",
+    "max_intensity",
+]
+
+
+def _grow(array, size, fill):
+    if array.shape[-1] >= size:
+        return array
+    grown = np.full(array.shape[:-1] + (size,), fill, dtype=array.dtype)
+    grown[..., : array.shape[-1]] = array
+    return grown
+
+
+def component_statistics(labels, mri, slab_slices=16, index_offset=(0, 0, 0)):
+    # labels and mri are ITK images on the same grid; label 0 is background.
+    # index_offset maps bounding boxes of a cropped grid back to the original.
+    label_array = itk.array_view_from_image(labels)
+    mri_array = itk.array_view_from_image(mri)
+    if label_array.shape != mri_array.shape:
+        raise ValueError(
+            f"labels shape={label_array.shape} does not match "
+            f"mri shape={mri_array.shape}"
+        )
+
+    counts = np.zeros(1, dtype=np.int64)
+    # Sums of (x, y, z) index coordinates and of intensities, per label
+    coord_sums = np.zeros((3, 1))
+    intensity_sums = np.zeros(1)
+    intensity_max = np.full(1, -np.inf)
+    bbox_min = np.full((3, 1), np.iinfo(np.int64).max)
+    bbox_max = np.full((3, 1), -1)
+    brain_voxels = 0
+
+    for z0 in range(0, label_array.shape[0], slab_slices):
+        label_slab = label_array[z0 : z0 + slab_slices]
+        mri_slab = mri_array[z0 : z0 + slab_slices]
+        brain_voxels += np.count_nonzero(mri_slab)
+
+        foreground = np.flatnonzero(label_slab)
+        if foreground.size == 0:
+            continue
+        ids = label_slab.ravel()[foreground].astype(np.intp)
+        values = mri_slab.ravel()[foreground].astype(np.float64)
+        z, y, x = np.unravel_index(foreground, label_slab.shape)
+        coords = np.stack([x, y, z + z0])
+
+        size = int(ids.max()) + 1
+        counts = _grow(counts, size, 0)
+        coord_sums = _grow(coord_sums, size, 0)
+        intensity_sums = _grow(intensity_sums, size, 0)
+        intensity_max = _grow(intensity_max, size, -np.inf)
+        bbox_min = _grow(bbox_min, size, np.iinfo(np.int64).max)
+        bbox_max = _grow(bbox_max, size, -1)
+
+        counts[:size] += np.bincount(ids, minlength=size)
+        intensity_sums[:size] += np.bincount(ids, weights=values, minlength=size)
+        np.maximum.at(intensity_max, ids, values)
+        for axis in range(3):
+            coord_sums[axis, :size] += np.bincount(
+                ids, weights=coords[axis], minlength=size
+            )
+            np.minimum.at(bbox_min[axis], ids, coords[axis])
+            np.maximum.at(bbox_max[axis], ids, coords[axis])
+
+    spacing = np.array(labels.GetSpacing())
+    origin = np.array(labels.GetOrigin())
+    direction = itk.array_from_matrix(labels.GetDirection())
+    voxel_volume = float(np.prod(spacing))
+    bbox_min = bbox_min + np.array(index_offset)[:, None]
+    bbox_max = bbox_max + np.array(index_offset)[:, None]
+
+    present = np.flatnonzero(counts)
+    present = present[present > 0]
+    centroids_index = coord_sums[:, present] / counts[present]
+    # Index -> physical point, the same mapping ITK uses
+    centroids = origin[:, None] + direction @ (spacing[:, None] * centroids_index)
+
+    rows = []
+    for i, label in enumerate(present):
+        voxels = int(counts[label])
+        rows.append(
+            {
+                "label": int(label),
+                "voxels": voxels,
+                "volume_mm3": voxels * voxel_volume,
+                "brain_fraction": voxels / brain_voxels if brain_voxels else 0.0,
+                "centroid_x": float(centroids[0, i]),
+                "centroid_y": float(centroids[1, i]),
+                "centroid_z": float(centroids[2, i]),
+                "bbox_min_x": int(bbox_min[0, label]),
+                "bbox_min_y": int(bbox_min[1, label]),
+                "bbox_min_z": int(bbox_min[2, label]),
+                "bbox_max_x": int(bbox_max[0, label]),
+                "bbox_max_y": int(bbox_max[1, label]),
+                "bbox_max_z": int(bbox_max[2, label]),
+                "mean_intensity": float(intensity_sums[label] / voxels),
+                "max_intensity": float(intensity_max[label]),
+            }
+        )
+    return {
+        "brain_voxels": int(brain_voxels),
+        "brain_volume_mm3": brain_voxels * voxel_volume,
+        "spacing": spacing.tolist(),
+        "components": rows,
+    }
+
+
+def write_csv(stats, path, case=None):
+    fields = (["case"] if case is not None else []) + STATS_FIELDS
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        for row in stats["components"]:
+            writer.writerow(dict(row, case=case) if case is not None else row)
+
+
+def write_json(stats, path):
+    with open(path, "w") as f:
+        json.dump(stats, f, indent=2)
+
+
+def analyze_case(path, filters=None):
+    # Runs the sample.py segmentation on one case and returns its statistics
+    from sample import CUSTOM_FILTERS, custom_morpho_filters, image_intensity_range
+    from sample import segment_mri_image
+
+    mri = read_image(path)
+    intensity_range = image_intensity_range(mri)
+    cropped = crop_image(mri)
+    connected_components = segment_mri_image(cropped, intensity_range=intensity_range)
+    cc_filters_result = custom_morpho_filters(
+        connected_components, filters=filters or CUSTOM_FILTERS, release_data=True
+    )
+    cc_filters_result[-1].Update()
+    stats = component_statistics(
+        cc_filters_result[-1].GetOutput(),
+        cropped,
+        index_offset=crop_offset(cropped, mri),
+    )
+    stats["case"] = path
+    return stats
+
+
+def analyze_cases(paths, jobs=None):
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        yield from zip(paths, pool.map(analyze_case, paths))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tumor component statistics")
+    parser.add_argument("paths", nargs="+", help="MRI volumes to analyze")
+    parser.add_argument("--out-dir", default=".")
+    parser.add_argument("--format", choices=["csv", "json"], default="csv")
+    parser.add_argument("--jobs", type=int, default=None)
+    args = parser.parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    for path, stats in analyze_cases(args.paths, args.jobs):
+        name = os.path.splitext(os.path.basename(path))[0]
+        out_path = os.path.join(args.out_dir, f"{name}_stats.{args.format}")
+        if args.format == "csv":
+            write_csv(stats, out_path, case=name)
+        else:
+            write_json(stats, out_path)
+        total = sum(row["volume_mm3"] for row in stats["components"])
+        print(f"{name}: {len(stats['components'])} components, {total:.1f} mm3")
@@ -0,0 +1,205 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import vtk
+
+"""
+    Binary cache for legacy .vtk inputs.
+    The first open parses the file and writes the image, with its active
+    scalars, as a compressed binary .vti; later opens read the .vti instead.
+    Entries are keyed on the source path and active scalars, dropped when the
+    source's mtime or size changes, and evicted least recently used first
+    when the cache grows beyond its disk budget. Processes sharing the cache
+    merge their index with the one on disk on every save.
+"""
+
+CACHE_DIR = os.environ.get(
+    "VIS_CACHE_DIR",
+    os.path.join(
+        os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+        "brain-vis",
+        "vtk",
+    ),
+)
+CACHE_BUDGET_BYTES = int(float(os.environ.get("VIS_CACHE_BUDGET_MB", 2048)) * 2**20)
+CACHE_INDEX_NAME = "index.json"
+
+
+def read_legacy(path, active_scalars=None):
+    reader = vtk.vtkDataSetReader()
+    reader.SetFileName(path)
+    reader.Update()
+    if active_scalars is not None:
+        reader.GetOutput().GetPointData().SetActiveScalars(active_scalars)
+    return reader
+
+
+class VtkCache:
+    def __init__(self, directory=CACHE_DIR, budget_bytes=CACHE_BUDGET_BYTES):
+        self.directory = directory
+        self.budget_bytes = budget_bytes
+        self.index_path = os.path.join(directory, CACHE_INDEX_NAME)
+        self.index = self.load_index()
+        # Keys removed since the last save, so the merge does not bring them back
+        self.removed = set()
+
+    def load_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def key(self, path, active_scalars):
+        source = f"{os.path.abspath(path)}\0{active_scalars}"
+        return hashlib.blake2b(source.encode(), digest_size=16).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key + ".vti")
+
+    def lookup(self, path, active_scalars=None):
+        # Path of a valid cached image for path, or None
+        key = self.key(path, active_scalars)
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        stat = os.stat(path)
+        if (
+            entry["mtime"] != stat.st_mtime
+            or entry["size"] != stat.st_size
+            or not os.path.exists(self.entry_path(key))
+        ):
+            self.remove(key)
+            self.save()
+            return None
+        entry["last_used"] = time.time()
+        self.save()
+        return self.entry_path(key)
+
+    def reader(self, path, active_scalars=None):
+        # Algorithm whose output is the dataset of path with active_scalars
+        # active, read from the cache when it holds a valid copy
+        cached = self.lookup(path, active_scalars)
+        if cached is not None:
+            reader = vtk.vtkXMLImageDataReader()
+            reader.SetFileName(cached)
+            reader.Update()
+            return reader
+        reader = read_legacy(path, active_scalars)
+        if reader.GetOutput().IsA("vtkImageData"):
+            # Only images are cached; other datasets are parsed every time
+            self.store(path, active_scalars, reader.GetOutput())
+        return reader
+
+    def store(self, path, active_scalars, image):
+        stat = os.stat(path)
+        key = self.key(path, active_scalars)
+        # Written under a name of its own so a partial file is never read
+        partial = f"{self.entry_path(key)}.{os.getpid()}.partial"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            writer = vtk.vtkXMLImageDataWriter()
+            writer.SetFileName(partial)
+            writer.SetInputData(image)
+            writer.SetDataModeToAppended()
+            writer.EncodeAppendedDataOff()
+            writer.SetCompressorTypeToLZ4()
+            if not writer.Write():
+                if os.path.exists(partial):
+                    os.remove(partial)
+                return
+            os.replace(partial, self.entry_path(key))
+            cached_bytes = os.path.getsize(self.entry_path(key))
+        except OSError as e:
+            # An unwritable cache only costs the conversion on the next open
+            print(f"Not caching {path}: {e}")
+            return
+        self.index[key] = {
+            "source": os.path.abspath(path),
+            "active_scalars": active_scalars,
+            "mtime": stat.st_mtime,
+            "size": stat.st_size,
+            "bytes": cached_bytes,
+            "last_used": time.time(),
+        }
+        self.save()
+
+    def evict(self):
+        # Least recently used first, until the cache fits its budget
+        total = sum(entry["bytes"] for entry in self.index.values())
+        for key in sorted(self.index, key=lambda k: self.index[k]["last_used"]):
+            if total <= self.budget_bytes:
+                break
+            total -= self.index[key]["bytes"]
+            self.remove(key)
+
+    def remove(self, key):
+        self.index.pop(key, None)
+        self.removed.add(key)
+        try:
+            os.remove(self.entry_path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for key in set(self.index) | set(self.load_index()):
+            self.remove(key)
+        self.save()
+
+    def merge(self):
+        # Other processes save to the same index: their entries are kept
+        # (the most recent use wins), and entries whose .vti is gone are dropped
+        index = self.load_index()
+        for key in self.removed:
+            index.pop(key, None)
+        for key, entry in self.index.items():
+            if key not in index or index[key]["last_used"] < entry["last_used"]:
+                index[key] = entry
+        self.index = {
+            key: entry
+            for key, entry in index.items()
+            if os.path.exists(self.entry_path(key))
+        }
+
+    def save(self):
+        if not os.path.isdir(self.directory):
+            return
+        self.merge()
+        self.evict()
+        partial = f"{self.index_path}.{os.getpid()}.partial"
+        try:
+            with open(partial, "w") as f:
+                json.dump(self.index, f, indent=1)
+            os.replace(partial, self.index_path)
+        except OSError as e:
+            print(f"Could not save the cache index: {e}")
+            return
+        self.removed = set()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Warm or inspect the .vtk cache")
+    parser.add_argument("paths", nargs="*", help=".vtk files to convert")
+    parser.add_argument("--scalars", default="s", help="active point scalars")
+    parser.add_argument("--clear", action="store_true")
+    args = parser.parse_args()
+
+    cache = VtkCache()
+    if args.clear:
+        cache.clear()
+    for path in args.paths:
+        started = time.perf_counter()
+        hit = cache.lookup(path, args.scalars) is not None
+        cache.reader(path, args.scalars)
+        print(
+            f"{path}: {'cached' if hit else 'converted'} in "
+            f"{time.perf_counter() - started:.2f} s"
+        )
+    total = sum(entry["bytes"] for entry in cache.index.values())
+    print(
+        f"{len(cache.index)} entries, {total / 2**20:.1f} of "
+        f"{cache.budget_bytes / 2**20:.0f} MiB in {cache.directory}"
+    )